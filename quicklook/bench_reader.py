@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import argparse
+from astropy.io import fits
+import multiprocessing
+import numpy as np
+from os import path
+import resource
+import sys
+import time
+
+import fitsstream
+
+def read_fits(filename):
+    with fits.open(filename) as hdulist:
+        data = hdulist[1].data
+        return sum(np.asarray(data[c]).nbytes for c in fitsstream.COLUMNS)
+
+def read_stream(filename):
+    hdulist = fitsstream.open_projected(filename)
+    return hdulist[1].data.nbytes
+
+READERS = {"fits": read_fits, "stream": read_stream}
+
+def run(reader, filenames, repeat, queue):
+    """Read every file repeat times in a fresh process and report
+    (seconds, bytes of columns read, peak RSS in MB)."""
+    read = READERS[reader]
+    nbytes = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for f in filenames:
+            nbytes += read(f)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux.
+    queue.put((seconds, nbytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare peak memory and throughput of the light curve readers.")
+    parser.add_argument("files", nargs="+", help="light curve FITS files")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of times to read every file")
+    parser.add_argument("--readers", nargs="+", choices=sorted(READERS),
+        default=["fits", "stream"])
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    compressed = sum(path.getsize(f) for f in args.files) * args.repeat / 1e6
+    n_files = len(args.files) * args.repeat
+    # Each reader runs in its own fresh process, so that peak RSS is its own.
+    context = multiprocessing.get_context("spawn")
+    print("{:8} {:>10} {:>12} {:>12} {:>12}".format(
+        "reader", "files/s", "input MB/s", "columns MB", "peak RSS MB"))
+    for reader in args.readers:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(reader, args.files, args.repeat, queue))
+        process.start()
+        seconds, nbytes, rss = queue.get()
+        process.join()
+        print("{:8} {:10.1f} {:12.1f} {:12.1f} {:12.1f}".format(
+            reader, n_files / seconds, compressed / seconds, nbytes / 1e6, rss))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+from astropy import table
+import numpy as np
+
+# Nominal Kepler cadences in minutes, for headers without TIMEDEL.
+LONG_CADENCE = 29.4244
+SHORT_CADENCE = 0.980814
+
+def cadence_minutes(hdulist):
+    """-> cadence of a Kepler light curve in minutes, read from its headers."""
+    if "TIMEDEL" in hdulist[1].header:
+        return hdulist[1].header["TIMEDEL"] * 24. * 60.
+    if "short" in str(hdulist[0].header.get("OBSMODE", "")).lower():
+        return SHORT_CADENCE
+    return LONG_CADENCE
+
+def bin_factor(cadence, target):
+    """-> how many cadences go into one bin of about target minutes; 1 means
+    the light curve is already at (or coarser than) the target."""
+    return max(int(round(target / cadence)), 1)
+
+def bin_reduce(time_col, width):
+    """-> (row where each bin starts, rows per bin) for bins of width in time.
+
+    Bins are aligned to multiples of width, so gaps simply produce fewer
+    bins. time_col must be sorted and finite.
+    """
+    bin_id = np.floor(time_col / width).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], bin_id[1:] != bin_id[:-1])))
+    counts = np.diff(np.concatenate((starts, [len(time_col)])))
+    return starts, counts
+
+def bin_mean(col, starts):
+    """-> mean of col in each bin, ignoring non-finite values."""
+    finite = np.isfinite(col)
+    total = np.add.reduceat(np.where(finite, col, 0.), starts)
+    n = np.add.reduceat(finite.astype(int), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, total / n, np.nan)
+
+def bin_clip(t, width, label_mode="any"):
+    """-> clip table binned to bins of width days.
+
+    TIME and SAP_FLUX are averaged. Labels are 1 if any cadence in the bin
+    is labelled with label_mode "any", or the labelled fraction of the bin
+    with "fraction".
+    """
+    if not len(t):
+        return t
+    starts, counts = bin_reduce(np.asarray(t["TIME"]), width)
+    columns = [bin_mean(np.asarray(t["TIME"], dtype=float), starts),
+               bin_mean(np.asarray(t["SAP_FLUX"], dtype=float), starts)]
+    for name in ("IN_TRANSIT", "EB_injection"):
+        labels = np.asarray(t[name])
+        if label_mode == "fraction":
+            columns.append(np.add.reduceat(labels, starts) / counts)
+        else:
+            columns.append(np.maximum.reduceat(labels, starts))
+    label_dtype = "f8" if label_mode == "fraction" else "i4"
+    meta = t.meta.copy()
+    meta["BIN_WIDTH"] = width
+    return table.Table(columns, names=("TIME", "SAP_FLUX", "IN_TRANSIT", "EB_injection"),
+        dtype=("f8", "f8", label_dtype, label_dtype), meta=meta)
+
+def fold(time_col, period, epoch):
+    """-> time since the nearest transit, in [-period / 2, period / 2)."""
+    return (time_col - epoch + period / 2.) % period - period / 2.
+
+def binned_view(phase, flux, lower, upper, n_bins):
+    """-> mean flux in n_bins equal bins spanning [lower, upper).
+
+    Empty bins are 0, i.e. at the median flux of a normalized light curve.
+    """
+    keep = (phase >= lower) & (phase < upper)
+    i = np.minimum(((phase[keep] - lower) / (upper - lower) * n_bins).astype(int), n_bins - 1)
+    total = np.bincount(i, weights=flux[keep], minlength=n_bins)
+    n = np.bincount(i, minlength=n_bins)
+    return np.where(n > 0, total / np.maximum(n, 1), 0.)
+
+def phase_views(time_col, flux_col, period, epoch, dur, n_global, n_local, local_durations):
+    """-> (global view, local view) of a phase folded light curve.
+
+    The flux is normalized to its median and has 1 subtracted. The global
+    view covers a whole period and the local view local_durations transit
+    durations centred on the transit. time_col and flux_col must be finite.
+    """
+    flux = flux_col / np.median(flux_col) - 1.
+    phase = fold(time_col, period, epoch)
+    global_view = binned_view(phase, flux, -period / 2., period / 2., n_global)
+    half_width = min(local_durations * dur / 2., period / 2.)
+    local_view = binned_view(phase, flux, -half_width, half_width, n_local)
+    return global_view, local_view
@@ -0,0 +1,320 @@
+from astropy import table
+import json
+import numpy as np
+import uuid
+
+import labels
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Data columns of a clip and their types, as written by quicklook.strip_cols.
+COLUMNS = (("TIME", "f8"), ("SAP_FLUX", "f8"), ("IN_TRANSIT", "i4"), ("EB_injection", "i4"))
+# Columns stored in full under /clips; the labels.NAMES are stored as intervals.
+DATA_COLUMNS = tuple((name, dtype) for name, dtype in COLUMNS if name not in labels.NAMES)
+# Attributes counting the committed rows of each group.
+COUNTERS = {"index": "n_committed", "headers": "n_headers_committed",
+            "views": "n_views_committed"}
+CHUNK = 1 << 16  # rows
+
+class ClipStore(object):
+    """All clips of a run in one HDF5 file.
+
+    The clip columns are concatenated into one chunked dataset each under
+    /clips, and /index holds one row per clip: the source light curve, the
+    output suffix quicklook would have used for its ECSV file, the KIC ID,
+    the clip's START and LENGTH in the column datasets, and its metadata as
+    JSON. /headers holds full FITS headers stored once per source light
+    curve, which clips written with a HEADER_REF point to. /views holds
+    fixed width phase folded views, one row per light curve, with the same
+    index fields as clips. Only clips committed by flush() are kept when a store is reopened,
+    so a store left behind by a killed run can be appended to safely, and
+    only those are read from a store opened read only.
+
+    Label columns are stored under /labels/<name> as the CLIP index and the
+    [START, STOP) rows, relative to the clip, of every labelled interval,
+    and only made into dense columns when read. Stores written before
+    labels were interval encoded hold them under /clips, and are still read
+    and appended to that way.
+
+    Every store gets a random store_id when it is first written to, so that
+    a store that was deleted or replaced can be told apart from the one
+    quicklook's journal recorded clips in.
+    """
+
+    def __init__(self, filename, mode="r", compression=None):
+        if h5py is None:
+            raise ImportError("h5py is needed to read or write {}".format(filename))
+        self.file = h5py.File(filename, mode)
+        self.writable = mode != "r"
+        if self.writable and "index" not in self.file:
+            self._create(compression)
+        self.dense_labels = "index" in self.file and "IN_TRANSIT" in self.file["clips"]
+        if self.writable and "headers" not in self.file:
+            self._create_headers()
+        if self.writable:
+            self._truncate(self.file.attrs["n_committed"])
+            if "store_id" not in self.file.attrs:
+                self.file.attrs["store_id"] = uuid.uuid4().hex
+                self.file.flush()
+        self.store_id = self.file.attrs.get("store_id")
+
+    def _create(self, compression):
+        clips = self.file.create_group("clips")
+        for name, dtype in DATA_COLUMNS:
+            clips.create_dataset(name, (0,), dtype=dtype, maxshape=(None,),
+                chunks=(CHUNK,), compression=compression)
+        for label in labels.NAMES:
+            group = self.file.create_group("labels/" + label)
+            for name in ("CLIP", "START", "STOP"):
+                group.create_dataset(name, (0,), dtype="i8", maxshape=(None,),
+                    chunks=(1024,), compression=compression)
+        index = self.file.create_group("index")
+        string = h5py.string_dtype()
+        for name, dtype in (("SOURCE", string), ("SUFFIX", string), ("KIC_ID", "i8"),
+                            ("START", "i8"), ("LENGTH", "i8"), ("META", string)):
+            index.create_dataset(name, (0,), dtype=dtype, maxshape=(None,), chunks=(1024,))
+        self.file.attrs["n_committed"] = 0
+
+    def _create_headers(self):
+        headers = self.file.create_group("headers")
+        string = h5py.string_dtype()
+        for name, dtype in (("SOURCE", string), ("KIC_ID", "i8"), ("HEADER", string)):
+            headers.create_dataset(name, (0,), dtype=dtype, maxshape=(None,), chunks=(1024,))
+        self.file.attrs["n_headers_committed"] = 0
+
+    def _truncate(self, n):
+        index = self.file["index"]
+        rows = int(index["START"][n - 1] + index["LENGTH"][n - 1]) if n else 0
+        for name in index:
+            index[name].resize((n,))
+        for name in self.file["clips"]:
+            self.file["clips"][name].resize((rows,))
+        for name in self.label_names():
+            group = self.file["labels"][name]
+            # Intervals are stored in clip order.
+            k = np.searchsorted(group["CLIP"][:], n)
+            for field in group:
+                group[field].resize((k,))
+        if "headers" in self.file:
+            for name in self.file["headers"]:
+                self.file["headers"][name].resize((self.file.attrs["n_headers_committed"],))
+        if "views" in self.file:
+            for name in self.file["views"]:
+                self.file["views"][name].resize(self.file.attrs["n_views_committed"], axis=0)
+
+    def label_names(self):
+        """-> names of the labels stored as intervals."""
+        return () if self.dense_labels else labels.NAMES
+
+    def _count(self, group):
+        """-> number of rows of the index, headers or views group to read:
+        every row while writing, which opening truncated to those committed,
+        and only the committed ones when reading."""
+        if self.writable:
+            return len(self.file[group]["SOURCE"])
+        return int(self.file.attrs[COUNTERS[group]])
+
+    def __len__(self):
+        return self._count("index")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, source, kic_id, clips):
+        """Append a list of (suffix, table) clips cut from one light curve."""
+        if not clips:
+            return
+        index = self.file["index"]
+        n = len(self)
+        rows = len(self.file["clips/TIME"])
+        lengths = np.array([len(t) for _, t in clips])
+        for name in self.file["clips"]:
+            data = self.file["clips"][name]
+            data.resize((rows + lengths.sum(),))
+            data[rows:] = np.concatenate([np.asarray(t[name]) for _, t in clips])
+        for name in self.label_names():
+            spans = [labels.intervals(t[name]) for _, t in clips]
+            self._append_intervals(name, np.repeat(np.arange(n, n + len(clips)),
+                [len(s) for s in spans]), np.concatenate(spans))
+        fields = {"SOURCE": [source] * len(clips), "SUFFIX": [s for s, _ in clips],
+                  "KIC_ID": [kic_id] * len(clips),
+                  "START": rows + np.cumsum(lengths) - lengths, "LENGTH": lengths,
+                  "META": [json.dumps(t.meta) for _, t in clips]}
+        for name, values in fields.items():
+            index[name].resize((n + len(clips),))
+            index[name][n:] = values
+
+    def _append_intervals(self, name, clip, spans):
+        group = self.file["labels"][name]
+        k = len(group["CLIP"])
+        for field, values in (("CLIP", clip), ("START", spans[:, 0]), ("STOP", spans[:, 1])):
+            group[field].resize((k + len(values),))
+            group[field][k:] = values
+
+    def append_header(self, source, kic_id, header):
+        """Store the full header of a source light curve."""
+        headers = self.file["headers"]
+        n = len(headers["SOURCE"])
+        for name, value in (("SOURCE", source), ("KIC_ID", kic_id),
+                            ("HEADER", json.dumps(header))):
+            headers[name].resize((n + 1,))
+            headers[name][n] = value
+
+    def _create_views(self, global_shape, local_shape):
+        views = self.file.create_group("views")
+        string = h5py.string_dtype()
+        for name, dtype, shape in (("SOURCE", string, ()), ("KIC_ID", "i8", ()),
+                                   ("EB_injection", "i4", ()), ("META", string, ()),
+                                   ("GLOBAL", "f4", global_shape),
+                                   ("LOCAL", "f4", local_shape)):
+            views.create_dataset(name, (0,) + shape, dtype=dtype,
+                maxshape=(None,) + shape, chunks=(256,) + shape)
+        self.file.attrs["n_views_committed"] = 0
+
+    def append_views(self, source, kic_id, t):
+        """Append the single row table of views made by quicklook.gather_views."""
+        if "views" not in self.file:
+            self._create_views(t["GLOBAL"].shape[1:], t["LOCAL"].shape[1:])
+        views = self.file["views"]
+        n = len(views["SOURCE"])
+        for name, value in (("SOURCE", source), ("KIC_ID", kic_id),
+                            ("EB_injection", t["EB_injection"][0]),
+                            ("META", json.dumps(t.meta)),
+                            ("GLOBAL", t["GLOBAL"][0]), ("LOCAL", t["LOCAL"][0])):
+            views[name].resize(n + 1, axis=0)
+            views[name][n] = value
+
+    def append_store(self, other):
+        """Append every clip, header and view committed to another store,
+        e.g. that of one shard of a run."""
+        if self.dense_labels != other.dense_labels:
+            raise ValueError("Can't merge stores with dense and interval encoded labels")
+        n = len(self)
+        rows = len(self.file["clips/TIME"])
+        m = int(other.file.attrs["n_committed"])
+        index = other.file["index"]
+        other_rows = int(index["START"][m - 1] + index["LENGTH"][m - 1]) if m else 0
+        for name in self.file["clips"]:
+            data = self.file["clips"][name]
+            data.resize((rows + other_rows,))
+            # Copy in blocks, so that memory use doesn't grow with the store.
+            for a in range(0, other_rows, CHUNK * 16):
+                b = min(a + CHUNK * 16, other_rows)
+                data[rows + a:rows + b] = other.file["clips"][name][a:b]
+        for name in self.label_names():
+            group = other.file["labels"][name]
+            k = np.searchsorted(group["CLIP"][:], m)
+            spans = np.column_stack((group["START"][:k], group["STOP"][:k]))
+            self._append_intervals(name, group["CLIP"][:k] + n, spans)
+        for name in self.file["index"]:
+            values = index[name][:m]
+            if name == "START":
+                values = values + rows
+            self.file["index"][name].resize((n + m,))
+            self.file["index"][name][n:] = values
+        for group, count in (("headers", "n_headers_committed"), ("views", "n_views_committed")):
+            if group not in other.file:
+                continue
+            if group not in self.file:
+                self._create_views(other.file["views/GLOBAL"].shape[1:],
+                                   other.file["views/LOCAL"].shape[1:])
+            k = int(other.file.attrs[count])
+            for name in self.file[group]:
+                data = self.file[group][name]
+                start = data.shape[0]
+                data.resize(start + k, axis=0)
+                data[start:] = other.file[group][name][:k]
+
+    def flush(self):
+        """Commit every clip, header and view appended so far to disk."""
+        self.file.attrs["n_committed"] = len(self)
+        if "headers" in self.file:
+            self.file.attrs["n_headers_committed"] = len(self.file["headers/SOURCE"])
+        if "views" in self.file:
+            self.file.attrs["n_views_committed"] = len(self.file["views/SOURCE"])
+        self.file.flush()
+
+    def close(self):
+        if self.writable:
+            self.flush()
+        self.file.close()
+
+    def index(self):
+        """-> astropy Table of every clip's index row, without metadata."""
+        index = self.file["index"]
+        n = len(self)
+        return table.Table([index["SOURCE"].asstr()[:n], index["SUFFIX"].asstr()[:n],
+                            index["KIC_ID"][:n], index["START"][:n], index["LENGTH"][:n]],
+                           names=("SOURCE", "SUFFIX", "KIC_ID", "START", "LENGTH"))
+
+    def label_intervals(self, i, name):
+        """-> (n, 2) array of the [start, stop) rows of clip i labelled name."""
+        if self.dense_labels:
+            return labels.intervals(self.column(i, name))
+        group = self.file["labels"][name]
+        clip = group["CLIP"][:]
+        a, b = np.searchsorted(clip, i), np.searchsorted(clip, i, side="right")
+        return np.column_stack((group["START"][a:b], group["STOP"][a:b]))
+
+    def column(self, i, name):
+        """-> one data column of clip i as an array."""
+        length = self.file["index/LENGTH"][i]
+        if name in self.label_names():
+            return labels.dense(self.label_intervals(i, name), length)
+        start = self.file["index/START"][i]
+        return self.file["clips"][name][start:start + length]
+
+    def split_column(self, name, packed=False):
+        """-> list of one data column of every clip, read in a single pass.
+
+        Label columns may be packed 8 rows per byte by np.packbits instead.
+        """
+        n = len(self)
+        if not n:
+            return []
+        starts = self.file["index/START"][:n]
+        lengths = self.file["index/LENGTH"][:n]
+        if name not in self.label_names():
+            rows = int(starts[-1] + lengths[-1])
+            columns = np.split(self.file["clips"][name][:rows], starts[1:])
+            return [np.packbits(c != 0) for c in columns] if packed else columns
+        group = self.file["labels"][name]
+        spans = np.column_stack((group["START"][:], group["STOP"][:]))
+        bounds = np.searchsorted(group["CLIP"][:], np.arange(n + 1))
+        make = labels.packed if packed else labels.dense
+        return [make(spans[a:b], length)
+                for a, b, length in zip(bounds[:-1], bounds[1:], lengths)]
+
+    def header(self, source):
+        """-> full header stored for a source light curve, or None."""
+        if "headers" not in self.file:
+            return None
+        sources = self.file["headers/SOURCE"].asstr()[:self._count("headers")]
+        match = np.flatnonzero(sources == source)
+        if not len(match):
+            return None
+        return json.loads(self.file["headers/HEADER"].asstr()[match[-1]])
+
+    def view_column(self, name):
+        """-> one column of every light curve's views, as an array."""
+        if "views" not in self.file:
+            return np.zeros(0)
+        return self.file["views"][name][:self._count("views")]
+
+    def clip(self, i, full_header=False):
+        """-> clip i as the astropy Table quicklook would have written.
+
+        If full_header, a clip that only has a HEADER_REF gets the full
+        header it refers to as metadata.
+        """
+        meta = json.loads(self.file["index/META"].asstr()[i])
+        if full_header and "HEADER_REF" in meta:
+            meta = self.header(meta["HEADER_REF"]) or meta
+        return table.Table([self.column(i, name) for name, _ in COLUMNS],
+            names=[name for name, _ in COLUMNS], meta=meta)
@@ -0,0 +1,85 @@
+import collections
+import errno
+import signal
+import threading
+import zlib
+
+import injection
+
+# Why a light curve gave fewer clips than it should have, or none.
+TRANSIT_OUT_OF_RANGE = "transit_out_of_range"
+NOT_MONOTONIC = "time_not_monotonic"
+NO_NEGATIVE = "no_negative"
+NONFINITE_TIME = "nonfinite_time"
+NO_GOOD_CADENCES = "no_good_cadences"
+MISSING_CATALOG = "missing_catalog_entry"
+CORRUPT = "corrupt"
+IO = "io"
+TIMEOUT = "timeout"
+OTHER = "other"
+
+# Failures that happen again on every run until the file or the catalog
+# changes.
+PERMANENT = frozenset((MISSING_CATALOG, CORRUPT))
+
+# I/O errors that may go away when the file is read again, e.g. on a
+# flaky network file system.
+TRANSIENT_ERRNOS = frozenset((errno.EIO, errno.EAGAIN, errno.EINTR, errno.EBUSY,
+                              errno.ETIMEDOUT, errno.ESTALE, errno.ECONNRESET))
+
+class Timeout(Exception):
+    """Raised when a light curve takes longer than its deadline."""
+
+class deadline(object):
+    """Context manager raising Timeout in the block after seconds of wall
+    time. Only works in the main thread on systems with SIGALRM, and does
+    nothing otherwise or if seconds is 0."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.armed = (seconds > 0 and hasattr(signal, "SIGALRM")
+                      and threading.current_thread() is threading.main_thread())
+
+    def _expire(self, signum, frame):
+        raise Timeout("took longer than {} s".format(self.seconds))
+
+    def __enter__(self):
+        if self.armed:
+            self.previous = signal.signal(signal.SIGALRM, self._expire)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, *exc):
+        if self.armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.previous)
+        return False
+
+def category(error):
+    """-> failure category of an exception raised while processing a file."""
+    if isinstance(error, (Timeout, TimeoutError)):
+        # TimeoutError is what quicklook's pipeline hands on for hung reads.
+        return TIMEOUT
+    if isinstance(error, injection.MissingEntry):
+        return MISSING_CATALOG
+    if isinstance(error, (EOFError, zlib.error)):
+        # A truncated or damaged gzip stream.
+        return CORRUPT
+    if isinstance(error, OSError):
+        return IO
+    return OTHER
+
+def is_transient(error):
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+# Category -> count for the file being processed.
+_counts = collections.Counter()
+
+def note(category):
+    _counts[category] += 1
+
+def take():
+    """-> dictionary of category to count since the last take()."""
+    out = dict(_counts)
+    _counts.clear()
+    return out
@@ -3,6 +3,9 @@ import numpy as np
 import sklearn
 import os
 
+import clipstore
+import suffixes
+
 
 
 
@@ -55,6 +58,59 @@ def fetchFluxTimeseries(path): #returns numpy array where rows are data points;
         labels[i] = padded2
     return (np.array(fluxes),np.array(labels))
 
+def splitSuffix(suffix): #returns (raw, policy, copy) of a clip suffix, see suffixes.split
+    return suffixes.split(suffix)[:3]
+
+def fetchStoreTimeseries(filename, negative=False, policy=None, copy=None): #same as fetchFluxTimeseries, but reads a quicklook HDF5 clip store
+    #negative picks the negative clips instead of the positive ones
+    #positives are those of one window policy (by name, "" for the default one) and optionally one copy of it;
+    #policy may only be left out if the store holds a single one. Raw clips are never picked
+    store = clipstore.ClipStore(filename)
+    parts = [splitSuffix(s) for s in store.index()["SUFFIX"]]
+    if not negative and policy is None:
+        policies = set(p for raw, p, _ in parts if not raw and p not in ("negative", "views"))
+        if len(policies) > 1:
+            store.close()
+            raise ValueError("{} holds clips of several policies {}, pick one".format(filename, sorted(policies)))
+        policy = policies.pop() if policies else ""
+    if negative:
+        picked = [not raw and p == "negative" for raw, p, _ in parts]
+    else:
+        picked = [not raw and p == policy and (copy is None or c == copy) for raw, p, c in parts]
+    fluxes = []
+    labels = []
+    for col, lab, pick in zip(store.split_column("SAP_FLUX"), store.split_column("IN_TRANSIT"), picked):
+        if pick and len(col)!=0 and not np.isnan(col).any(): #ignore timeseries with NaNs
+            fluxes.append(col)
+            labels.append(lab)
+    store.close()
+    maxlen = max(len(col) for col in fluxes)
+    padded = np.zeros((len(fluxes),maxlen))
+    padded2 = np.zeros((len(fluxes),maxlen))
+    for i in range(len(fluxes)):
+        padded[i,:len(fluxes[i])]=fluxes[i]
+        padded2[i,:len(labels[i])]=labels[i]
+    return (padded,padded2)
+
+def fetchViews(path): #returns (global views, local views, labels) from the quicklook --views ECSV files in path
+    #views already have a fixed length, so no padding is needed; label is 1 for EBs
+    global_views = []
+    local_views = []
+    labels = []
+    for f in os.listdir(path):
+        if f.endswith("_quicklook_views.ecsv"):
+            tbl = astropy.io.ascii.read(path+"/"+f)
+            global_views.append(np.array(tbl["GLOBAL"][0]))
+            local_views.append(np.array(tbl["LOCAL"][0]))
+            labels.append(tbl["EB_injection"][0])
+    return (np.array(global_views),np.array(local_views),np.array(labels))
+
+def fetchStoreViews(filename): #same as fetchViews, but reads a quicklook HDF5 clip store
+    store = clipstore.ClipStore(filename)
+    out = (store.view_column("GLOBAL"),store.view_column("LOCAL"),store.view_column("EB_injection"))
+    store.close()
+    return out
+
 def fetchPosNegTimeseries(pathpos,pathneg): #returns numpy array where rows are data points; 
     #each point is a vector of fluxes, currently padded with zeros to the length of the longest one
     fluxes = []
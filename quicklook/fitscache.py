@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import logging
+import os
+from os import path
+import shutil
+
+# Evicting goes down to this fraction of max_bytes, so that the cache is only
+# scanned again once a number of new copies have been made.
+LOW_WATER = 0.9
+
+class FitsCache(object):
+    """Directory of decompressed copies of gzipped FITS files, which can be
+    memory mapped instead of being decompressed again.
+
+    Copies are keyed by the source path, size and mtime, so a changed
+    source gets a new copy and the stale one ages out. Once the copies take
+    more than max_bytes, the least recently used are deleted down to
+    LOW_WATER of it, sparing only the copy being handed out. The size of
+    the cache is kept as a running total, which the directory is only
+    scanned to correct when it goes over max_bytes.
+
+    Copies are written to a temporary file and renamed into place, so
+    several worker processes can share one cache directory. Each of them
+    only counts its own copies between scans though, so a shared cache can
+    go over max_bytes by what the others added since. A copy another
+    process evicts before it is opened is made again by the next get(),
+    which quicklook.open_file retries with.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.total = None  # bytes as of the last scan, plus the copies made since.
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filename):
+        filename = path.abspath(filename)
+        stat = os.stat(filename)
+        source = "{}\0{}\0{}".format(filename, stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def get(self, filename):
+        """-> path of the decompressed copy of filename, made if needed."""
+        cached = path.join(self.directory, self.key(filename) + ".fits")
+        try:
+            # Touching the copy marks it as recently used.
+            os.utime(cached)
+            self.hits += 1
+            return cached
+        except FileNotFoundError:
+            pass
+        self.misses += 1
+        tmp = "{}.{}.tmp".format(cached, os.getpid())
+        try:
+            with gzip.open(filename, "rb") as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(tmp, cached)
+        finally:
+            if path.exists(tmp):
+                os.remove(tmp)
+        if self.total is None:
+            self.total = self.scan()[1]
+        else:
+            self.total += path.getsize(cached)
+        if self.total > self.max_bytes:
+            self.evict(keep=cached)
+        return cached
+
+    def scan(self):
+        """-> ((mtime, bytes, path) of every copy, total bytes)"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".fits"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Evicted by another worker.
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def evict(self, keep=None):
+        """Delete the least recently used copies, other than keep, until they
+        fit LOW_WATER of max_bytes."""
+        entries, total = self.scan()
+        for mtime, size, filename in sorted(entries):
+            if total <= LOW_WATER * self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass  # Evicted by another worker.
+            total -= size
+        self.total = total
+        logging.info("FITS cache holds %d bytes, %d hits, %d misses", total,
+            self.hits, self.misses)
+
+# Cache of this process, or None while caching is disabled.
+_cache = None
+
+def enable(directory, max_bytes):
+    global _cache
+    _cache = FitsCache(directory, max_bytes)
+
+def local_path(filename):
+    """-> decompressed copy of a gzipped file if caching is enabled, or
+    filename itself."""
+    if _cache is None or not filename.endswith(".gz"):
+        return filename
+    return _cache.get(filename)
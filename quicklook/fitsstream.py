@@ -0,0 +1,156 @@
+from astropy.io import fits
+import gzip
+import numpy as np
+import re
+import threading
+
+BLOCK = 2880  # bytes
+CARD = 80  # bytes
+CHUNK_ROWS = 4096
+# Light curve columns used by quicklook.
+COLUMNS = ("TIME", "SAP_FLUX", "SAP_QUALITY")
+# Binary table TFORM codes that can be read straight into NumPy.
+FORMATS = {"L": "i1", "B": "u1", "I": ">i2", "J": ">i4", "K": ">i8", "E": ">f4", "D": ">f8",
+           "A": "S1"}
+
+class StreamedHDU(object):
+    """Header and data of one HDU read by StreamReader."""
+
+    def __init__(self, header, data=None):
+        self.header = header
+        self.data = data
+
+class StreamedHDUList(list):
+    """List of StreamedHDU that can stand in for a fits.HDUList."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+def read_header(f):
+    """-> fits.Header read block by block from a file object, up to END."""
+    blocks = []
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            raise EOFError("Truncated FITS header")
+        blocks.append(block)
+        if any(block[i:i + 8] == b"END     " for i in range(0, BLOCK, CARD)):
+            return fits.Header.fromstring(b"".join(blocks).decode("ascii"))
+
+def data_size(header):
+    """-> bytes of data following header, including the padding to a block."""
+    naxis = [header["NAXIS{}".format(i)] for i in range(1, header["NAXIS"] + 1)]
+    if not naxis:
+        return 0
+    size = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * (
+        int(np.prod(naxis)) + header.get("PCOUNT", 0))
+    return -(-size // BLOCK) * BLOCK
+
+def row_dtype(header, columns):
+    """-> big-endian dtype picking columns out of one row of a binary table.
+    Columns the table doesn't have are left out."""
+    names, formats, offsets = [], [], []
+    offset = 0
+    for i in range(1, header["TFIELDS"] + 1):
+        match = re.match(r"^(\d*)([A-Z])", header["TFORM{}".format(i)].strip())
+        repeat = int(match.group(1) or 1)
+        code = match.group(2)
+        name = header["TTYPE{}".format(i)].strip()
+        if code not in FORMATS:
+            if name in columns:
+                raise ValueError("Cannot stream column {} of format {}".format(
+                    name, header["TFORM{}".format(i)]))
+            # Variable length and complex columns only matter for their width.
+            width = {"X": -(-repeat // 8), "C": 8 * repeat, "M": 16 * repeat,
+                     "P": 8, "Q": 16}[code]
+        else:
+            width = np.dtype(FORMATS[code]).itemsize * repeat
+        if name in columns:
+            if "TSCAL{}".format(i) in header or "TZERO{}".format(i) in header:
+                raise ValueError("Cannot stream scaled column {}".format(name))
+            names.append(name)
+            if code == "A":
+                formats.append("S{}".format(repeat))
+            else:
+                formats.append((FORMATS[code], repeat) if repeat > 1 else FORMATS[code])
+            offsets.append(offset)
+        offset += width
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets,
+                     "itemsize": header["NAXIS1"]})
+
+class StreamReader(object):
+    """Reads the light curve table of (gzipped) FITS files while
+    decompressing them, keeping only some columns.
+
+    Rows are read CHUNK_ROWS at a time into one buffer and only the
+    projected columns are copied out, into native byte order arrays which
+    are reused by the next file whenever they are big enough. Data returned
+    by read() is therefore only valid until the next call.
+    """
+
+    def __init__(self, columns=COLUMNS, chunk_rows=CHUNK_ROWS):
+        self.columns = tuple(columns)
+        self.chunk_rows = chunk_rows
+        self.buffer = bytearray()
+        self.out = None
+
+    def read(self, filename, ext=1):
+        """-> StreamedHDUList of every header up to extension ext, with the
+        projected columns of ext as data."""
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rb") as f:
+            hdus = StreamedHDUList()
+            for _ in range(ext):
+                header = read_header(f)
+                skip = data_size(header)
+                while skip:
+                    got = len(f.read(min(skip, 1 << 20)))
+                    if not got:
+                        raise EOFError("Truncated FITS data")
+                    skip -= got
+                hdus.append(StreamedHDU(header))
+            header = read_header(f)
+            hdus.append(StreamedHDU(header, self._read_rows(f, header)))
+        return hdus
+
+    def _read_rows(self, f, header):
+        dtype = row_dtype(header, self.columns)
+        n_rows, row_bytes = header["NAXIS2"], header["NAXIS1"]
+        native = np.dtype([(name, dtype.fields[name][0].newbyteorder("="))
+                           for name in dtype.names])
+        if self.out is None or self.out.dtype != native or len(self.out) < n_rows:
+            self.out = np.empty(max(n_rows, len(self.out) if self.out is not None else 0),
+                                dtype=native)
+        if len(self.buffer) < self.chunk_rows * row_bytes:
+            self.buffer = bytearray(self.chunk_rows * row_bytes)
+        view = memoryview(self.buffer)
+        done = 0
+        while done < n_rows:
+            k = min(self.chunk_rows, n_rows - done)
+            n = 0
+            while n < k * row_bytes:
+                got = f.readinto(view[n:k * row_bytes])
+                if not got:
+                    raise EOFError("Truncated FITS table")
+                n += got
+            rows = np.frombuffer(self.buffer, dtype=dtype, count=k)
+            for name in dtype.names:
+                self.out[name][done:done + k] = rows[name]
+            done += k
+        return self.out[:n_rows]
+
+# One reader per thread, so that its buffers are reused across files.
+_local = threading.local()
+
+def open_projected(filename):
+    """-> StreamedHDUList of a light curve with only the COLUMNS quicklook
+    uses, read by this thread's StreamReader."""
+    if not hasattr(_local, "reader"):
+        _local.reader = StreamReader()
+    return _local.reader.read(filename)
@@ -1,16 +1,171 @@
 from astropy.io import ascii
 from astropy.io import fits
+import hashlib
+import json
+import logging
+import numpy as np
+import os
 from os import path
+import shutil
+
+# Columns of the injected transits table that quicklook actually uses.
+CACHED_COLUMNS = ("KIC_ID", "i_epoch", "i_period", "i_dur", "EB_injection")
 
 def parse_injected_table(filename):
     injected = ascii.read(filename, format="ipac")
     return injected
 
-def index_injected_table(injected_table):
-    injected_index = {}
-    for i, row in enumerate(injected_table):
-        injected_index[row["KIC_ID"]] = i
-    return injected_index
+def file_signature(filename):
+    """-> dictionary of the size, mtime and SHA-1 of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return {"size": path.getsize(filename), "mtime": path.getmtime(filename),
+            "sha1": sha1.hexdigest()}
+
+def cache_is_fresh(filename, cache_dir, columns):
+    """-> whether the cache in cache_dir was built from the current filename."""
+    try:
+        with open(path.join(cache_dir, "source.json")) as f:
+            source = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not all(path.exists(path.join(cache_dir, c + ".npy")) for c in columns):
+        return False
+    if path.getsize(filename) != source["size"]:
+        return False
+    if path.getmtime(filename) == source["mtime"]:
+        return True
+    # Only hash the table when the mtime changed, e.g. after a copy.
+    return file_signature(filename)["sha1"] == source["sha1"]
+
+def build_injected_cache(filename, cache_dir, columns):
+    """Convert the IPAC table into one .npy file per column in cache_dir."""
+    logging.info("Building injected table cache %s", cache_dir)
+    injected = parse_injected_table(filename)
+    tmp = "{}.{}.tmp".format(cache_dir, os.getpid())
+    os.makedirs(tmp)
+    try:
+        for c in columns:
+            np.save(path.join(tmp, c + ".npy"), np.asarray(injected[c]))
+        with open(path.join(tmp, "source.json"), "w") as f:
+            json.dump(file_signature(filename), f)
+        if path.exists(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        os.rename(tmp, cache_dir)
+    except OSError:
+        # Most likely a concurrent worker got there first.
+        if not cache_is_fresh(filename, cache_dir, columns):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def load_injected_table(filename, columns=CACHED_COLUMNS, cache=True):
+    """-> dictionary of column name to array for the injected transits table.
+
+    The columns are read from memory mapped .npy files in filename + ".cache",
+    which is rebuilt whenever the source table changes. If the cache can't be
+    written the IPAC table is parsed directly.
+    """
+    if not cache:
+        injected = parse_injected_table(filename)
+        return {c: np.asarray(injected[c]) for c in columns}
+    cache_dir = filename + ".cache"
+    if not cache_is_fresh(filename, cache_dir, columns):
+        try:
+            build_injected_cache(filename, cache_dir, columns)
+        except OSError as e:
+            logging.warning("Cannot cache injected table in %s: %s", cache_dir, e)
+            return load_injected_table(filename, columns, cache=False)
+    return {c: np.load(path.join(cache_dir, c + ".npy"), mmap_mode="r")
+            for c in columns}
+
+class MissingEntry(KeyError):
+    """KeyError for a star that isn't in the injected transits table."""
+
+# Packed per-star parameters returned by InjectedIndex. i_dur is in hours and
+# ROW is the row of the star in the injected transits table.
+RECORD_DTYPE = np.dtype([("KIC_ID", "i8"), ("i_epoch", "f8"), ("i_period", "f8"),
+                         ("i_dur", "f8"), ("EB_injection", "i4"), ("ROW", "i8")])
+
+class InjectedIndex(object):
+    """Sorted array index from KIC ID to injected transit parameters.
+
+    duplicates decides which row is kept for a star listed more than once:
+    "last" (what the old per-row dictionary ended up with), "first", or
+    "error" to refuse such a table.
+    """
+
+    def __init__(self, injected_table, duplicates="last"):
+        kic_ids = np.asarray(injected_table["KIC_ID"])
+        order = np.argsort(kic_ids, kind="stable")
+        sorted_ids = kic_ids[order]
+        repeated = sorted_ids[1:] == sorted_ids[:-1]
+        if duplicates == "first":
+            keep = np.concatenate(([True], ~repeated))
+        elif duplicates == "last":
+            keep = np.concatenate((~repeated, [True]))
+        elif duplicates == "error":
+            keep = np.ones(len(sorted_ids), dtype=bool)
+        else:
+            raise ValueError("Unknown duplicates policy {!r}".format(duplicates))
+        if repeated.any():
+            dup_ids = np.unique(sorted_ids[1:][repeated])
+            if duplicates == "error":
+                raise ValueError("{} stars are injected more than once, e.g. KIC {}".format(
+                    len(dup_ids), dup_ids[0]))
+            logging.warning("%d stars are injected more than once; keeping the %s row",
+                len(dup_ids), duplicates)
+        keep = keep[:len(order)]  # An empty table has no first or last row.
+        rows = order[keep]
+        self.kic_ids = sorted_ids[keep]
+        self.records = np.empty(len(rows), dtype=RECORD_DTYPE)
+        for c in CACHED_COLUMNS:
+            self.records[c] = np.asarray(injected_table[c])[rows]
+        self.records["ROW"] = rows
+
+    def __len__(self):
+        return len(self.kic_ids)
+
+    def __contains__(self, kic_id):
+        return self.find([kic_id])[0] >= 0
+
+    def __getitem__(self, kic_id):
+        """-> record of a single star, raising MissingEntry if it wasn't injected."""
+        i = self.find([kic_id])[0]
+        if i < 0:
+            raise MissingEntry(kic_id)
+        return self.records[i]
+
+    def find(self, kic_ids):
+        """-> positions of kic_ids in self.records, -1 where missing."""
+        kic_ids = np.asarray(kic_ids, dtype=self.kic_ids.dtype)
+        if not len(self.kic_ids):
+            return np.full(kic_ids.shape, -1, dtype=np.intp)
+        i = np.searchsorted(self.kic_ids, kic_ids)
+        i = np.minimum(i, len(self.kic_ids) - 1)
+        return np.where(self.kic_ids[i] == kic_ids, i, -1)
+
+    def lookup(self, kic_ids):
+        """-> (records, found) for an array of KIC IDs.
+
+        Records of stars that weren't injected are zeroed apart from KIC_ID
+        and have found set to False.
+        """
+        i = self.find(kic_ids)
+        found = i >= 0
+        records = np.zeros(i.shape, dtype=RECORD_DTYPE)
+        records[found] = self.records[i[found]]
+        records["KIC_ID"] = kic_ids
+        return records, found
+
+    def lookup_filenames(self, filenames):
+        """-> (records, found) for a list of light curve file names."""
+        return self.lookup([parse_injected_filename(f) for f in filenames])
+
+def index_injected_table(injected_table, duplicates="last"):
+    return InjectedIndex(injected_table, duplicates)
 
 def parse_injected_filename(filename):
     """-> KIC ID of the file"""
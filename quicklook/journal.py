@@ -0,0 +1,97 @@
+import json
+from os import path
+import sqlite3
+import time
+
+# Statuses after which a file does not need to be processed again. Anything
+# else (e.g. "error") is retried on the next run.
+DONE_STATUSES = ("ok", "no_clips")
+
+def file_key(filename):
+    """-> (absolute path, size, mtime) identifying one version of a file."""
+    filename = path.abspath(filename)
+    try:
+        stat = path.getsize(filename), path.getmtime(filename)
+    except OSError:
+        stat = None, None
+    return (filename,) + stat
+
+class Journal(object):
+    """SQLite record of which input files a quicklook run has finished.
+
+    A file counts as finished only if its size, mtime and the extraction
+    parameters all match what was recorded, so touching a file or changing
+    the padding constants makes it eligible again. The same goes for the
+    number of consecutive runs a file failed in, and whether it failed in a
+    way that can't go away without a change to the file or parameters,
+    which decide whether it is quarantined. Files are recorded once per set
+    of parameters, so going back to earlier ones, e.g. an earlier clip
+    store, doesn't redo the files finished with them.
+    """
+
+    def __init__(self, filename, params):
+        self.params = json.dumps(params, sort_keys=True)
+        # Only used from one thread at a time, but not always the one that
+        # opened it, e.g. the writer thread of quicklook's pipeline.
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_table()
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+        # Journals written before failures were counted.
+        for name in ("failures", "permanent"):
+            if name not in columns:
+                self.conn.execute(
+                    "ALTER TABLE files ADD COLUMN {} INTEGER DEFAULT 0".format(name))
+        key = [row[1] for row in sorted(self.conn.execute("PRAGMA table_info(files)"),
+                                        key=lambda row: row[5]) if row[5]]
+        if key == ["path"]:
+            # Journals written before each file was recorded per set of
+            # parameters, e.g. per clip store.
+            self.conn.execute("ALTER TABLE files RENAME TO files_old")
+            self._create_table()
+            self.conn.execute("INSERT INTO files SELECT path, size, mtime, params, status, "
+                              "n_clips, updated, failures, permanent FROM files_old")
+            self.conn.execute("DROP TABLE files_old")
+        self.conn.commit()
+
+    def _create_table(self):
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT, size INTEGER, mtime REAL, params TEXT,
+            status TEXT, n_clips INTEGER, updated REAL,
+            failures INTEGER DEFAULT 0, permanent INTEGER DEFAULT 0,
+            PRIMARY KEY (path, params))""")
+
+    def _current(self, filename):
+        """-> (status, failures, permanent) recorded for this version of
+        filename and these parameters, or None."""
+        key = file_key(filename)
+        row = self.conn.execute(
+            "SELECT size, mtime, status, failures, permanent FROM files "
+            "WHERE path = ? AND params = ?", (key[0], self.params)).fetchone()
+        if row is None or tuple(row[:2]) != key[1:]:
+            return None
+        return row[2:]
+
+    def is_done(self, filename):
+        row = self._current(filename)
+        return row is not None and row[0] in DONE_STATUSES
+
+    def is_quarantined(self, filename, after):
+        """-> whether filename failed permanently or in the last after runs."""
+        row = self._current(filename)
+        return (after > 0 and row is not None and row[0] == "error"
+            and (bool(row[2]) or row[1] >= after))
+
+    def record(self, filename, status, n_clips, permanent=False):
+        failures = 0
+        if status == "error":
+            row = self._current(filename)
+            failures = 1 + (row[1] if row is not None and row[0] == "error" else 0)
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            file_key(filename) + (self.params, status, n_clips, time.time(),
+                                  failures, int(permanent)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
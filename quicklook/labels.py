@@ -0,0 +1,30 @@
+import numpy as np
+
+# Labels of clip cadences, which quicklook keeps as [start, stop) intervals
+# of row indices rather than as dense columns that are almost all zero.
+NAMES = ("IN_TRANSIT", "EB_injection")
+
+def clip_intervals(starts, stops, i_start, i_stop):
+    """-> (n, 2) array of the labelled intervals [starts, stops) of a light
+    curve that overlap rows [i_start, i_stop), relative to i_start."""
+    starts = np.clip(np.atleast_1d(starts), i_start, i_stop) - i_start
+    stops = np.clip(np.atleast_1d(stops), i_start, i_stop) - i_start
+    keep = stops > starts
+    return np.column_stack((starts[keep], stops[keep])).astype(np.int64)
+
+def intervals(mask):
+    """-> (n, 2) array of the [start, stop) runs of nonzero values of mask."""
+    edges = np.diff(np.concatenate(([0], np.asarray(mask) != 0, [0])).astype(np.int8))
+    return np.column_stack((np.flatnonzero(edges == 1),
+                            np.flatnonzero(edges == -1))).astype(np.int64)
+
+def dense(intervals, length, dtype="i4"):
+    """-> mask of length rows that is 1 within intervals."""
+    out = np.zeros(length, dtype=dtype)
+    for a, b in intervals:
+        out[a:b] = 1
+    return out
+
+def packed(intervals, length):
+    """-> the mask of dense() packed 8 rows per byte by np.packbits."""
+    return np.packbits(dense(intervals, length, bool))
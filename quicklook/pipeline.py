@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+
+# Marks the end of a stage's output.
+_DONE = object()
+
+class Failure(object):
+    """Exception raised by a read, passed on in place of its result."""
+
+    def __init__(self, error):
+        self.error = error
+
+def run(items, read, compute, write, readers=2, read_ahead=4, write_behind=4,
+        read_timeout=0):
+    """Run read(item) in reader threads, compute(item, read result) in the
+    calling thread and write(compute result) in a writer thread.
+
+    At most read_ahead read results and write_behind compute results wait
+    between stages, so memory stays bounded whichever stage is slowest. A
+    read that raises hands compute a Failure instead. Items may be a lazy
+    iterable, and are computed in the order reads finish.
+
+    A read taking more than read_timeout seconds (unless 0) hands compute a
+    Failure of TimeoutError. Its thread can't be interrupted, so it is left
+    to finish in the background, its result unused, while a new reader
+    thread takes its place.
+    """
+    items = iter(items)
+    items_lock = threading.Lock()
+    # Reader thread -> (item, start time) of its read in progress.
+    reading = {}
+    stop = threading.Event()
+    loaded = queue.Queue(read_ahead)
+    written = queue.Queue(write_behind)
+    errors = []
+
+    def put(q, value):
+        # Give up if the pipeline is being torn down and nobody will get it.
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        me = threading.current_thread()
+        while not stop.is_set():
+            with items_lock:
+                item = next(items, _DONE)
+                if item is not _DONE:
+                    reading[me] = (item, time.monotonic())
+            if item is _DONE:
+                break
+            try:
+                value = read(item)
+            except Exception as e:
+                value = Failure(e)
+            with items_lock:
+                if reading.pop(me, None) is None:
+                    return  # Timed out and replaced by another reader.
+            put(loaded, (item, value))
+        put(loaded, _DONE)
+
+    def start_reader():
+        t = threading.Thread(target=reader, daemon=True)
+        t.start()
+        return t
+
+    def timed_out():
+        """-> items whose reads took longer than read_timeout, replacing
+        their reader threads."""
+        now = time.monotonic()
+        with items_lock:
+            late = [(t, item) for t, (item, start) in reading.items()
+                    if now - start > read_timeout]
+            for t, _ in late:
+                del reading[t]
+        for _ in late:
+            start_reader()
+        return [item for _, item in late]
+
+    def writer():
+        while True:
+            try:
+                value = written.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if value is _DONE:
+                return
+            try:
+                write(value)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                return
+
+    write_thread = threading.Thread(target=writer, daemon=True)
+    write_thread.start()
+    for _ in range(readers):
+        start_reader()
+    try:
+        running = readers
+        while running and not errors:
+            if read_timeout > 0:
+                for item in timed_out():
+                    error = TimeoutError("read took longer than {} s".format(read_timeout))
+                    put(written, compute(item, Failure(error)))
+            try:
+                value = loaded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if value is _DONE:
+                running -= 1
+                continue
+            put(written, compute(*value))
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        # Whatever was computed still gets written.
+        put(written, _DONE)
+        write_thread.join()
+        stop.set()
+    if errors:
+        raise errors[0]
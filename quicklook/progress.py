@@ -0,0 +1,108 @@
+import collections
+import json
+import os
+import sys
+import time
+
+# Bytes of light curve data decompressed by this process since the last
+# take_decompressed(), counted by whichever stage decompresses.
+_decompressed = 0
+
+def note_decompressed(nbytes):
+    global _decompressed
+    _decompressed += nbytes
+
+def take_decompressed():
+    global _decompressed
+    out, _decompressed = _decompressed, 0
+    return out
+
+def format_seconds(seconds):
+    """-> H:MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+class Progress(object):
+    """Throughput of a run so far, updated once per finished file.
+
+    Every interval seconds, a one line summary is written to stderr if
+    display and a JSON snapshot to status_file if given. Utilization is the
+    fraction of the run's wall time each worker process spent on files, and
+    overall that of the time of all workers slots.
+    """
+
+    def __init__(self, total_files, total_bytes, display=False, status_file=None,
+                 interval=5., workers=1):
+        self.workers = max(workers, 1)
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.display = display
+        self.status_file = status_file
+        self.interval = interval
+        self.start = self.last_report = time.time()
+        self.files = self.bytes = self.decompressed = self.clips = 0
+        self.statuses = collections.Counter()
+        self.failures = collections.Counter()
+        self.busy = collections.Counter()
+
+    def update(self, nbytes, status, n_clips, failed=None, usage=None):
+        """Count a finished file of nbytes on disk; usage is (worker process
+        id, seconds spent on the file, bytes decompressed)."""
+        self.files += 1
+        self.bytes += nbytes
+        self.clips += n_clips
+        self.statuses[status] += 1
+        if failed:
+            self.failures.update(failed)
+        if usage is not None:
+            pid, seconds, decompressed = usage
+            self.busy[pid] += seconds
+            self.decompressed += decompressed
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.report(now)
+
+    def snapshot(self, now=None):
+        """-> dictionary of the counters and rates of the run so far."""
+        elapsed = max((now or time.time()) - self.start, 1e-9)
+        if self.bytes:
+            eta = (self.total_bytes - self.bytes) * elapsed / self.bytes
+        elif self.files:
+            eta = (self.total_files - self.files) * elapsed / self.files
+        else:
+            eta = None
+        return collections.OrderedDict([
+            ("elapsed_seconds", elapsed), ("files", self.files),
+            ("total_files", self.total_files), ("files_per_second", self.files / elapsed),
+            ("input_mb_per_second", self.bytes / elapsed / 1e6),
+            ("decompressed_mb_per_second", self.decompressed / elapsed / 1e6),
+            ("clips", self.clips), ("clips_per_second", self.clips / elapsed),
+            ("statuses", dict(self.statuses)), ("failures", dict(self.failures)),
+            ("utilization", sum(self.busy.values()) / (self.workers * elapsed)),
+            ("worker_utilization", {str(pid): busy / elapsed
+                                    for pid, busy in sorted(self.busy.items())}),
+            ("eta_seconds", eta)])
+
+    def report(self, now=None):
+        self.last_report = now or time.time()
+        s = self.snapshot(self.last_report)
+        if self.display:
+            sys.stderr.write(
+                "\r{}/{} files, {:.1f} files/s, {:.1f} MB/s in, {:.1f} MB/s decompressed, "
+                "{:.1f} clips/s, {:.0%} busy, {} errors, ETA {}   ".format(
+                    s["files"], s["total_files"], s["files_per_second"],
+                    s["input_mb_per_second"], s["decompressed_mb_per_second"],
+                    s["clips_per_second"], s["utilization"], s["statuses"].get("error", 0),
+                    "?" if s["eta_seconds"] is None else format_seconds(s["eta_seconds"])))
+            sys.stderr.flush()
+        if self.status_file:
+            tmp = "{}.{}.tmp".format(self.status_file, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(s, f, indent=2)
+            os.replace(tmp, self.status_file)
+
+    def close(self):
+        self.report()
+        if self.display:
+            sys.stderr.write("\n")
@@ -1,16 +1,41 @@
 #!/usr/bin/python3
 
+import argparse
 from astropy import table
 from astropy.io import fits, ascii
 import collections
+import functools
+import glob
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
 import numpy as np
+import os
 from os import path
-import random
+import re
+import resource
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 
+import binning
+import clipstore
+import failures
+import fitscache
+import fitsstream
 import injection
+import journal
+import labels
+import pipeline
+import progress
+import stitch
+import suffixes
+import timing
+import validation
 
 # Whether to randomize padding. if True, will be randomly selected between
 # BOUND_TOL_LOWER and BOUND_TOL_UPPER. If False, will use fixed BOUND_TOL.
@@ -21,6 +46,30 @@ BOUND_TOL_UPPER = 1.  # day
 BOUND_TOL_LOWER = 2./24  # day
 NEG_UPPER = 2.  # day; upper bound for time span of negative samples.
 NEG_LOWER = 8. / 24  # day; lower bound for time span of negative samples.
+# Fraction of the cadences of its time span a negative sample must hold.
+NEG_MIN_COVERAGE = 0.5
+INJECTED_TABLE = "/mnt/data/meta/kplr_dr25_inj1_plti.txt"
+GLOBAL_BINS = 2001  # bins in the phase folded view of a whole period.
+LOCAL_BINS = 201  # bins in the phase folded view around the transit.
+LOCAL_DURATIONS = 4.  # transit durations spanned by the local view.
+RAW_PAD = 2.  # day; default padding of raw clips cut for rewindow.py.
+RAW_NEGATIVE = 3 * NEG_UPPER  # day; longest raw negative clips.
+# Header cards kept on every clip when the full header is only stored once.
+HEADER_KEYS = ("OBJECT", "KEPLERID", "QUARTER", "SEASON", "CHANNEL", "OBSMODE",
+               "TSTART", "TSTOP", "TIMEDEL")
+
+# How to pad transits into clips: name goes into the output suffix, copies
+# is how many clips (with different random padding) to cut per transit and
+# the rest are the arguments of pad_transits.
+WindowPolicy = collections.namedtuple("WindowPolicy",
+    ("name", "randomize", "bound_tol", "lower", "upper", "copies"))
+
+# Per-process copies of the injected transits index and the command line
+# arguments, set once by init_worker in every pool worker instead of being
+# pickled with each task.
+_worker_index = None
+_worker_args = None
+_worker_plan = None
 
 def dictify(fits_header):
     """-> dictionary representation of the FITS header.
@@ -36,142 +85,1337 @@ def dictify(fits_header):
             out[k] = None
     return out
 
-def find_time_range(table_start, table_stop, epoch, period, dur, name="Unknown"):
-    # Find how many periods since epoch is the transit in the light curve.
-    num_period = (table_start - epoch) // period + 1  # VERY IMPORTANT OFF BY ONE.
-    # Calculate the start and stop times of the transit.
-    mid_transit = epoch + period * num_period  # Time of mid-transit
-    half_width = dur / 2.
-    transit_start = mid_transit - half_width
-    transit_stop = mid_transit + half_width
-    logging.info("The table start and stop period for %s is %s, %s", name, table_start, table_stop)
-    logging.info("The transit start and stop period for %s is %s, %s", name, transit_start, transit_stop)
-    if table_start >= transit_start or transit_stop >= table_stop:
-        logging.error("Transit outside light curve range for %s!", name)
-        return None, None, None, None
-    # Sanity checking.
-    if RANDOMIZE_BOUND:
+def header_summary(hdulist, ref):
+    """-> the HEADER_KEYS cards of a light curve, plus HEADER_REF pointing to
+    where its full header is stored."""
+    out = collections.OrderedDict()
+    for k in HEADER_KEYS:
+        # Cards of the light curve extension win over the primary header.
+        for hdu in (hdulist[1], hdulist[0]):
+            if k in hdu.header:
+                out[k] = hdu.header[k]
+                break
+    out["HEADER_REF"] = ref
+    return dictify(out)
+
+def default_policy():
+    """-> the WindowPolicy of the module constants, with unchanged suffixes."""
+    return WindowPolicy("", RANDOMIZE_BOUND, BOUND_TOL, BOUND_TOL_LOWER, BOUND_TOL_UPPER, 1)
+
+def parse_policy(spec):
+    """-> WindowPolicy from a command line spec.
+
+    Specs are [NAME=]fixed[:BOUND_TOL] or [NAME=]random[:COPIES[:LOWER:UPPER]],
+    with times in days and defaults from the module constants; NAME defaults
+    to fixed or random, and is checked by check_policy.
+    """
+    name, _, spec = spec.rpartition("=")
+    kind, _, rest = spec.partition(":")
+    try:
+        values = [float(x) for x in rest.split(":")] if rest else []
+    except ValueError:
+        raise ValueError("Bad window policy {!r}".format(spec))
+    if kind == "fixed" and len(values) <= 1:
+        return check_policy(WindowPolicy(name or kind, False,
+            values[0] if values else BOUND_TOL, BOUND_TOL_LOWER, BOUND_TOL_UPPER, 1))
+    if kind == "random" and len(values) in (0, 1, 3):
+        lower, upper = values[1:] if len(values) == 3 else (BOUND_TOL_LOWER, BOUND_TOL_UPPER)
+        copies = int(values[0]) if values else 1
+        return check_policy(WindowPolicy(name or kind, True, BOUND_TOL, lower, upper, copies))
+    raise ValueError("Bad window policy {!r}".format(spec))
+
+def check_policy(policy):
+    """-> policy, if the suffixes of its clips can be told apart from those
+    of other clips, or else raise ValueError."""
+    if policy.name in suffixes.RESERVED or not re.match(r"^\w*$", policy.name):
+        raise ValueError("Window policies cannot be named {!r}".format(policy.name))
+    for copy in range(policy.copies):
+        prefix = policy_prefix(policy, copy)
+        parts = (False, policy.name, copy if policy.copies > 1 else None)
+        if any(suffixes.split(s)[:3] != parts for s in (prefix, suffixes.with_epoch(prefix, 1))):
+            raise ValueError("Clips of window policy {!r} would be named like those of "
+                             "another policy".format(policy.name))
+    return policy
+
+def load_policies(filename):
+    """-> list of WindowPolicy from a JSON list of objects with the fields of
+    WindowPolicy, missing ones defaulting to default_policy()."""
+    with open(filename) as f:
+        specs = json.load(f)
+    return [check_policy(default_policy()._replace(**spec)) for spec in specs]
+
+def policy_prefix(policy, copy):
+    """-> output suffix for copy number copy of policy's clips."""
+    prefix = "quicklook_" + policy.name if policy.name else "quicklook"
+    return prefix + ("_{:02d}".format(copy) if policy.copies > 1 else "")
+
+def pad_transits(transit_start, transit_stop, randomize=None, bound_tol=None,
+                 lower=None, upper=None):
+    """-> (start, stop) of the clip around a transit, or arrays thereof.
+
+    The padding settings default to RANDOMIZE_BOUND, BOUND_TOL,
+    BOUND_TOL_LOWER and BOUND_TOL_UPPER.
+    """
+    randomize = RANDOMIZE_BOUND if randomize is None else randomize
+    if randomize:
         # For LSTM, padding should be randomized in order to prevent overfitting based on
         # when the transit starts in the light curve.
-        start = transit_start - random.uniform(BOUND_TOL_LOWER, BOUND_TOL_UPPER)
-        stop = transit_stop + random.uniform(BOUND_TOL_LOWER, BOUND_TOL_UPPER)
+        lower = BOUND_TOL_LOWER if lower is None else lower
+        upper = BOUND_TOL_UPPER if upper is None else upper
+        size = np.shape(transit_start) or None
+        start = transit_start - np.random.uniform(lower, upper, size)
+        stop = transit_stop + np.random.uniform(lower, upper, size)
     else:
         # Constant padding otherwise.
-        start = transit_start - BOUND_TOL
-        stop = transit_stop - BOUND_TOL
-    # Check that transit is not clipped by data boundary
-    if table_start >= start or stop >= table_stop:
-        logging.warning("Transit too close to light curve broundary for %s!", name)
-    logging.info("The start and stop period for {} is {}, {}".format(name, start, stop))
-    return start, stop, transit_start, transit_stop
-
-def strip_rows(time_col, time_start, time_stop, name="Unknown"):
-    # Sanity check: is the table sorted by time?
-    for a, b in zip(time_col[:-1], time_col[1:]):
-        if a >= b:
+        bound_tol = BOUND_TOL if bound_tol is None else bound_tol
+        start = transit_start - bound_tol
+        stop = transit_stop + bound_tol
+    return start, stop
+
+def transit_times(table_start, table_stop, epoch, period, dur):
+    """-> (light curve index, epoch numbers, start times, stop times) of every
+    transit that overlaps a light curve, even partially. The arguments may
+    be arrays with one entry per light curve."""
+    table_start, table_stop, epoch, period, dur = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float))
+          for x in (table_start, table_stop, epoch, period, dur)))
+    half_width = dur / 2.
+    first = (table_start - half_width - epoch) // period + 1
+    last = -((epoch - table_stop - half_width) // period) - 1  # Rounded up.
+    counts = np.maximum(last - first + 1, 0).astype(int)
+    row = np.repeat(np.arange(len(counts)), counts)
+    # Count up from the first epoch number of each light curve.
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    num_period = np.repeat(first, counts) + offset
+    mid_transit = epoch[row] + period[row] * num_period
+    return (row, num_period.astype(int), mid_transit - half_width[row],
+            mid_transit + half_width[row])
+
+def select_transits(table_start, table_stop, epoch, period, dur, all_transits=False):
+    """-> transit_times of the transits to clip: every transit that lies
+    inside its light curve if all_transits, or else the first one after
+    TSTART, if it lies inside."""
+    row, num_period, transit_start, transit_stop = transit_times(
+        table_start, table_stop, epoch, period, dur)
+    table_start, table_stop, epoch, period = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float))
+          for x in (table_start, table_stop, epoch, period)))
+    keep = (table_start[row] < transit_start) & (transit_stop < table_stop[row])
+    if not all_transits:
+        first = (table_start - epoch) // period + 1  # VERY IMPORTANT OFF BY ONE.
+        keep &= num_period == first[row]
+    return row[keep], num_period[keep], transit_start[keep], transit_stop[keep]
+
+def clip_fits(table_start, table_stop, start, stop, all_transits=False):
+    """-> which clip windows to cut: with all_transits only those that lie
+    inside the light curve, otherwise all of them."""
+    if all_transits:
+        return (table_start < start) & (stop < table_stop)
+    return np.ones(len(start), dtype=bool)
+
+def plan_windows(table_start, table_stop, epoch, period, dur, all_transits=False,
+                 seeds=None):
+    """-> (light curve index, epoch number, start, stop, transit start, transit
+    stop) arrays with one entry per clip, for arrays of light curves.
+
+    These are the windows gather_data cuts with the default policy: the
+    select_transits padded by pad_transits, kept if clip_fits. If seeds are
+    given, the padding of each light curve is drawn after seeding the random
+    generator with its seed, as extract_file does.
+    """
+    row, num_period, transit_start, transit_stop = select_transits(
+        table_start, table_stop, epoch, period, dur, all_transits)
+    if seeds is None:
+        start, stop = pad_transits(transit_start, transit_stop)
+    else:
+        start, stop = np.empty(len(row)), np.empty(len(row))
+        bounds = np.searchsorted(row, np.arange(len(seeds) + 1))
+        for seed, a, b in zip(seeds, bounds[:-1], bounds[1:]):
+            if b > a:
+                np.random.seed(seed)
+                start[a:b], stop[a:b] = pad_transits(transit_start[a:b], transit_stop[a:b])
+    ok = clip_fits(table_start[row], table_stop[row], start, stop, all_transits)
+    return (row[ok], num_period[ok], start[ok], stop[ok],
+            transit_start[ok], transit_stop[ok])
+
+def strip_rows(time_col, time_start, time_stop, name="Unknown", report=None):
+    """report is the LightCurveReport of time_col, if already computed."""
+    with timing.stage("strip_rows"):
+        # Sanity check: is the table sorted by time?
+        if report is None:
+            report = validation.LightCurveReport(time_col)
+        if not report.monotonic:
             logging.error("Time flew backwards or stood still in %s", name)
+            failures.note(failures.NOT_MONOTONIC)
             return None, None
-    index_start = np.searchsorted(time_col, time_start)
-    index_stop = np.searchsorted(time_col, time_stop, side="right")
+        index_start = np.searchsorted(time_col, time_start)
+        index_stop = np.searchsorted(time_col, time_stop, side="right")
     return index_start, index_stop
 
-def strip_rows_negative(time_col, time_start, time_stop, name="Unknown"):
-    # Choose a duration for the negative sample.
-    dur = random.uniform(NEG_LOWER, NEG_UPPER)
-    # Randomly find a start and stop time that does not overlap with interval.
-    for i in range(100):
-        neg_start = random.choice(time_col)
-        neg_stop = neg_start + dur
-        if not ((neg_start <= time_stop) and (time_start <= neg_stop)):
-            break
-    else:
-        logging.error("Cannot find a negative sample in %s", name)
-        return None, None
-    return strip_rows(time_col, neg_start, neg_stop, name)
+def free_intervals(time_start, time_stop, avoid_start, avoid_stop):
+    """-> (starts, stops) of the parts of [time_start, time_stop] not covered
+    by any of the avoided intervals."""
+    order = np.argsort(avoid_start)
+    avoid_start = np.asarray(avoid_start, dtype=float)[order]
+    # Merge overlapping intervals: an interval extends the previous one
+    # whenever it starts before every earlier interval has stopped.
+    avoid_stop = np.maximum.accumulate(np.asarray(avoid_stop, dtype=float)[order])
+    starts = np.concatenate(([time_start], avoid_stop))
+    stops = np.concatenate((avoid_start, [time_stop]))
+    stops = np.minimum(stops, time_stop)
+    starts = np.maximum(starts, time_start)
+    keep = stops > starts
+    return starts[keep], stops[keep]
 
-def make_label_column(length, start, stop):
-    out = np.zeros(length)
-    out[start:stop] = 1
-    return out
+def sample_negative_windows(time_start, time_stop, avoid_start, avoid_stop, n,
+                            name="Unknown", lower=None, upper=None, rng=None):
+    """-> (starts, stops) of up to n non-overlapping negative windows.
 
-def strip_cols(fits_table, i_start, i_stop, transit_col, eb_col, name="Unknown"):
-    metadata = dictify(fits_table.header)
-    columns = [fits_table.data["TIME"], fits_table.data["SAP_FLUX"], transit_col, eb_col]
-    stripped = [c[i_start:i_stop] for c in columns]
-    # Sanity check: no time value is NaN or inf
-    if not np.all(np.isfinite(stripped[0])):
-        logging.warning("Non-finite time detected in clip for %s", name)
-        return None
-    t = table.Table(stripped,
-        names=("TIME", "SAP_FLUX", "IN_TRANSIT", "EB_injection"),
-        dtype=("f8", "f8", "i4", "i4"), meta=metadata)
+    Window lengths are drawn between lower and upper, which default to
+    NEG_LOWER and NEG_UPPER. Each free interval between the avoided ones is
+    cut into slots as long as the longest window, n slots are drawn at
+    random and every window is placed at a random offset inside its slot.
+    If the drawn lengths don't fit, the windows fall back to lower before
+    settling for fewer. Random numbers come from rng, a RandomState, or
+    else from np.random.
+    """
+    rng = np.random if rng is None else rng
+    lower = NEG_LOWER if lower is None else lower
+    upper = NEG_UPPER if upper is None else upper
+    free_start, free_stop = free_intervals(time_start, time_stop, avoid_start, avoid_stop)
+    dur = rng.uniform(lower, upper, n)
+    slot = dur.max() if n else lower
+    n_slots = np.floor((free_stop - free_start) / slot).astype(int)
+    if n_slots.sum() < n:
+        # Try again with the shortest windows allowed.
+        dur = np.full(n, lower)
+        slot = lower
+        n_slots = np.floor((free_stop - free_start) / slot).astype(int)
+    if n_slots.sum() < n:
+        logging.error("Only %d of %d negative samples fit in %s", n_slots.sum(), n, name)
+        failures.note(failures.NO_NEGATIVE)
+        n = n_slots.sum()
+        dur = dur[:n]
+    # Shift the slots of each interval by a random amount of its slack.
+    phase = free_start + rng.uniform(0, 1, len(n_slots)) * (
+        free_stop - free_start - n_slots * slot)
+    chosen = np.sort(rng.choice(n_slots.sum(), n, replace=False))
+    first_slot = np.cumsum(n_slots) - n_slots
+    interval = np.searchsorted(first_slot, chosen, side="right") - 1
+    neg_start = (phase[interval] + (chosen - first_slot[interval]) * slot
+                 + rng.uniform(0, 1, n) * (slot - dur))
+    return neg_start, neg_start + dur
+
+def raw_negative_windows(time_start, time_stop, avoid_start, avoid_stop, n,
+                         name="Unknown", lower=None, upper=RAW_NEGATIVE, rng=None):
+    """-> (starts, stops) of up to n free intervals between the avoided ones,
+    for rewindow.py to sample negatives from.
+
+    Only intervals at least lower (by default NEG_LOWER) long are drawn, and
+    those longer than upper are cut down to a window of that length at a
+    random offset. rng is as for sample_negative_windows.
+    """
+    rng = np.random if rng is None else rng
+    lower = NEG_LOWER if lower is None else lower
+    free_start, free_stop = free_intervals(time_start, time_stop, avoid_start, avoid_stop)
+    usable = np.flatnonzero(free_stop - free_start >= lower)
+    if len(usable) < n:
+        logging.error("Only %d of %d raw negative samples fit in %s", len(usable), n, name)
+        failures.note(failures.NO_NEGATIVE)
+        n = len(usable)
+    chosen = np.sort(rng.choice(usable, n, replace=False))
+    slack = np.maximum(free_stop[chosen] - free_start[chosen] - upper, 0)
+    start = free_start[chosen] + rng.uniform(0, 1, n) * slack
+    return start, np.minimum(start + upper, free_stop[chosen])
+
+def strip_cols(fits_table, i_start, i_stop, transit=None, eb=None, name="Unknown",
+               metadata=None, report=None):
+    """-> table of rows [i_start, i_stop) of a light curve.
+
+    transit and eb are (starts, stops) of the rows labelled IN_TRANSIT and
+    EB_injection in the whole light curve, or None if no row is. Label
+    columns are only made as long as the clip.
+    """
+    if metadata is None:
+        with timing.stage("dictify"):
+            metadata = dictify(fits_table.header)
+    with timing.stage("strip_cols") as s:
+        stripped = [fits_table.data["TIME"][i_start:i_stop],
+                    fits_table.data["SAP_FLUX"][i_start:i_stop]]
+        length = len(stripped[0])
+        for rows in (transit, eb):
+            spans = labels.clip_intervals(rows[0], rows[1], i_start, i_stop) if rows else ()
+            stripped.append(labels.dense(spans, length))
+        # Sanity check: no time value is NaN or inf
+        if report is not None:
+            finite = report.finite_times(i_start, i_stop)
+        else:
+            finite = np.all(np.isfinite(stripped[0]))
+        if not finite:
+            logging.warning("Non-finite time detected in clip for %s", name)
+            failures.note(failures.NONFINITE_TIME)
+            return None
+        t = table.Table(stripped,
+            names=("TIME", "SAP_FLUX", "IN_TRANSIT", "EB_injection"),
+            dtype=("f8", "f8", "i4", "i4"), meta=metadata)
+        s.nbytes = sum(c.nbytes for c in t.columns.values())
     return t
 
-def gather_data(filename, injected_table, injected_table_index):
-    with fits.open(filename) as hdulist:
+def source_root(filename):
+    """-> name of the outputs of a light curve file, or of a tuple of the
+    quarter files of one target, which are stitched together."""
+    if isinstance(filename, tuple):
+        return stitch.group_root(filename)
+    return path.basename(filename).split(".")[0]
+
+def open_file(filename, reader="fits"):
+    """-> HDUList of one light curve file, read from its decompressed copy
+    in the FITS cache (memory mapped) if caching is enabled.
+
+    With reader "stream", files are read by fitsstream.open_projected, which
+    only keeps the columns quicklook uses.
+    """
+    for attempt in range(2):
+        local = fitscache.local_path(filename)
+        try:
+            if reader == "stream":
+                return fitsstream.open_projected(local)
+            if local != filename:
+                return fits.open(local, memmap=True)
+            return fits.open(filename)
+        except FileNotFoundError:
+            # Another worker may have evicted the copy before it was opened,
+            # in which case the next local_path makes it again.
+            if local == filename or attempt:
+                raise
+
+def open_light_curve(filename, reader="fits"):
+    """-> HDUList of a light curve file or stitched tuple of files, opened
+    with open_file."""
+    open_file_with = functools.partial(open_file, reader=reader)
+    with timing.stage("open") as s:
+        if isinstance(filename, tuple):
+            hdulist = stitch.stitch_quarters(filename, open_file_with)
+            s.nbytes = sum(path.getsize(f) for f in filename)
+        else:
+            hdulist = open_file_with(filename)
+            s.nbytes = path.getsize(filename)
+    return hdulist
+
+def light_curve_metadata(hdulist, filename, header_mode="full"):
+    """-> (metadata for every clip, header to store once or None)"""
+    with timing.stage("dictify"):
+        metadata = dictify(hdulist[1].header)
+        if header_mode != "ref":
+            return metadata, None
+        return header_summary(hdulist, source_root(filename)), metadata
+
+def gather_data(filename, injected_index, all_transits=False, negatives=1,
+                header_mode="full", windows=None, target_cadence=None, label_binning="any",
+                raw_pad=None, policies=None, reader="fits", hdulist=None,
+                negative_rng=None):
+    """-> (list of (output suffix, clip table), header) from a light curve.
+
+    Each WindowPolicy in policies (by default just default_policy()) pads
+    the transits into clips of its own. If all_transits, every transit
+    whose clip is fully covered gets one, named by its epoch number;
+    otherwise only the first transit is clipped. Up to
+    negatives clips without any transit are also extracted. With header_mode
+    "full" every clip carries the whole FITS header and header is None; with
+    "ref" clips only carry header_summary and header is returned once.
+    windows are the planned (epoch numbers, starts, stops, transit starts,
+    transit stops) of the clips, if a plan from make_plan is followed.
+    Light curves whose cadence is at least twice as fine as target_cadence
+    (minutes) have their clips binned to about that cadence. If raw_pad is
+    given, "raw" clips reaching raw_pad days either side of each transit
+    (and negatives of up to RAW_NEGATIVE days, see raw_negative_windows) are
+    cut instead, with the transit
+    times in their metadata, for rewindow.py to cut final clips from.
+    filename may also be a tuple of the quarter files of one target, which
+    are stitched into one light curve so that clips can span quarters.
+    reader is passed on to open_light_curve, unless the light curve was
+    already opened as hdulist. Negatives are drawn from negative_rng, a
+    RandomState, if given, and otherwise from np.random like the padding.
+    """
+    clips = []
+    header = None
+    if hdulist is None:
+        hdulist = open_light_curve(filename, reader)
+    with hdulist:
+        metadata, header = light_curve_metadata(hdulist, filename, header_mode)
         # Extract KIC ID part of the file name.
-        kic_id = injection.parse_injected_filename(filename)
-        injected_i = injected_table_index[kic_id]
+        kic_id = injection.parse_injected_filename(source_root(filename))
+        params = injected_index[kic_id]
         # Extract row metadata
-        epoch = injected_table["i_epoch"][injected_i]
-        period = injected_table["i_period"][injected_i]
-        dur = injected_table["i_dur"][injected_i] / 24.  # hour
+        epoch = params["i_epoch"]
+        period = params["i_period"]
+        dur = params["i_dur"] / 24.  # hour
         table_start = hdulist[1].header["TSTART"]
         table_stop = hdulist[1].header["TSTOP"]
         name = hdulist[1].header["OBJECT"]
-        # Find when the transit starts and stops in the FITS file.
-        start, stop, transit_start, transit_stop = find_time_range(table_start, table_stop, epoch, period, dur, name)
-        # When find_time_range fails, you know you are fucked.
-        if start is None:
-            return None, None
-        time_col = hdulist[1].data["TIME"]
+        # Find when the transits start and stop in the FITS file.
+        if windows is not None:
+            num_period, planned_start, planned_stop, transit_start, transit_stop = windows
+        else:
+            logging.info("The table start and stop period for %s is %s, %s", name,
+                table_start, table_stop)
+            _, num_period, transit_start, transit_stop = select_transits(
+                table_start, table_stop, epoch, period, dur, all_transits)
+            if not len(num_period):
+                logging.error("Transit outside light curve range for %s!", name)
+                failures.note(failures.TRANSIT_OUT_OF_RANGE)
+                if not all_transits:
+                    return clips, header
+        # Pad the transits into clip windows, as (suffix prefix, starts, stops).
+        sample_negatives = sample_negative_windows
+        if raw_pad is not None:
+            padded = [("quicklook_raw", np.maximum(transit_start - raw_pad, table_start),
+                       np.minimum(transit_stop + raw_pad, table_stop))]
+            sample_negatives = raw_negative_windows
+        elif windows is not None and policies is None:
+            padded = [("quicklook", planned_start, planned_stop)]
+        else:
+            padded = []
+            for policy in policies or [default_policy()]:
+                for k in range(policy.copies):
+                    start, stop = pad_transits(transit_start, transit_stop, policy.randomize,
+                        policy.bound_tol, policy.lower, policy.upper)
+                    padded.append((policy_prefix(policy, k), start, stop))
+        names, start, stop, clip_transit_start, clip_transit_stop = [], [], [], [], []
+        for prefix, pad_start, pad_stop in padded:
+            # Only keep clips that fit in the light curve.
+            keep = clip_fits(table_start, table_stop, pad_start, pad_stop,
+                             all_transits and raw_pad is None)
+            if all_transits and raw_pad is None:
+                logging.info("%d transits are fully covered by %s clips in %s",
+                    keep.sum(), prefix, name)
+            elif raw_pad is None and not clip_fits(table_start, table_stop,
+                                                   pad_start, pad_stop, True).all():
+                # Check that the transit is not clipped by the data boundary.
+                logging.warning("Transit too close to light curve boundary for %s!", name)
+            for n in num_period[keep]:
+                names.append(suffixes.with_epoch(prefix, n) if all_transits else prefix)
+            start.append(pad_start[keep])
+            stop.append(pad_stop[keep])
+            clip_transit_start.append(transit_start[keep])
+            clip_transit_stop.append(transit_stop[keep])
+        start, stop = np.concatenate(start), np.concatenate(stop)
+        clip_transit_start = np.concatenate(clip_transit_start)
+        clip_transit_stop = np.concatenate(clip_transit_stop)
+        # Every transit in the light curve, including those that only fit
+        # partially, which negatives must avoid.
+        _, _, every_start, every_stop = transit_times(table_start, table_stop, epoch,
+                                                     period, dur)
+        if all_transits:
+            # Label them all, since they may show up in a padded clip.
+            label_start, label_stop = every_start, every_stop
+        else:
+            label_start, label_stop = transit_start, transit_stop
+        if not len(start):
+            return clips, header
+        with timing.stage("decompress") as s:
+            data = hdulist[1].data
+            s.nbytes = data.nbytes
+        progress.note_decompressed(data.nbytes)
+        time_col = data["TIME"]
+        # Check the whole light curve once for every window cut out of it.
+        with timing.stage("validate"):
+            report = validation.validate_light_curve(data)
+        logging.info("Light curve report for %s: %s", name, report.summary())
         # Strip out the rows that are actually transts.
-        i_start, i_stop = strip_rows(time_col, start, stop, name)
+        i_start, i_stop = strip_rows(time_col, start, stop, name, report)
         if i_start is None:
-            return None, None
-        # Also generate the negative samples
-        i_neg_start, i_neg_stop = strip_rows_negative(time_col, start, stop, name)
+            return clips, header
+        # Also generate the negative samples, avoiding every clip and transit,
+        # and the gaps in the data, e.g. downlinks, safe modes and between
+        # stitched quarters.
+        avoid_start = np.concatenate((start, every_start, report.gaps[:, 0]))
+        avoid_stop = np.concatenate((stop, every_stop, report.gaps[:, 1]))
+        neg_start, neg_stop = sample_negatives(np.nanmin(time_col), np.nanmax(time_col),
+            avoid_start, avoid_stop, negatives, name, rng=negative_rng)
+        i_neg_start, i_neg_stop = strip_rows(time_col, neg_start, neg_stop, name, report)
+        # Gaps too short to count as such can still leave a window with few
+        # cadences.
+        covered = ((i_neg_stop - i_neg_start) * report.cadence
+                   >= NEG_MIN_COVERAGE * (neg_stop - neg_start))
+        if not covered.all():
+            logging.error("Dropping %d negative samples with too few cadences in %s",
+                (~covered).sum(), name)
+            failures.note(failures.NO_NEGATIVE)
+            i_neg_start, i_neg_stop = i_neg_start[covered], i_neg_stop[covered]
         # Find transit start and stop indices
-        i_transit_start, i_transit_stop = strip_rows(time_col, transit_start, transit_stop, name)
+        i_transit_start, i_transit_stop = strip_rows(time_col, label_start, label_stop,
+            name, report)
         # Extract information of whether an eclipsing binary is being simulated
-        is_eb = injected_table["EB_injection"][injected_i]
-        zeros = np.zeros(len(time_col))
-        if is_eb:
-            transit_col = zeros
-            eb_col = make_label_column(len(time_col), i_transit_start, i_transit_stop)
-        else:
-            transit_col = make_label_column(len(time_col), i_transit_start, i_transit_stop)
-            eb_col = zeros
+        is_eb = params["EB_injection"]
+        transit = None if is_eb else (i_transit_start, i_transit_stop)
+        eb = (i_transit_start, i_transit_stop) if is_eb else None
         # Only preserve the TIME and SAP_FLUX columns of the light curve.
         # Also add tag for whether the mid transit point has passed.
-        t = strip_cols(hdulist[1], i_start, i_stop, transit_col, eb_col, name)
-        if i_neg_start is None or is_eb:
-            neg_t = None
+        for suffix, a, b, ts, tp in zip(names, i_start, i_stop, clip_transit_start,
+                                        clip_transit_stop):
+            clip_metadata = metadata
+            if raw_pad is not None:
+                clip_metadata = collections.OrderedDict(metadata)
+                clip_metadata["TRANSIT_START"] = ts
+                clip_metadata["TRANSIT_STOP"] = tp
+            clips.append((suffix, strip_cols(hdulist[1], a, b, transit, eb, name,
+                clip_metadata, report)))
+        if not is_eb:
+            for j, (a, b) in enumerate(zip(i_neg_start, i_neg_stop)):
+                suffix = "quicklook_raw" if raw_pad is not None else "quicklook"
+                suffix += "_negative" + ("_{:02d}".format(j) if j else "")
+                clips.append((suffix, strip_cols(hdulist[1], a, b, name=name,
+                    metadata=metadata, report=report)))
+        if target_cadence:
+            cadence = binning.cadence_minutes(hdulist)
+            factor = binning.bin_factor(cadence, target_cadence)
+            if factor > 1:
+                logging.info("Binning %s by %d cadences", name, factor)
+                with timing.stage("bin"):
+                    width = factor * cadence / (24. * 60.)  # day
+                    clips = [(suffix, binning.bin_clip(t, width, label_binning))
+                             for suffix, t in clips if t is not None]
+    return [(suffix, t) for suffix, t in clips if t is not None], header
+
+def gather_views(filename, injected_index, n_global=GLOBAL_BINS, n_local=LOCAL_BINS,
+                 header_mode="full", reader="fits", hdulist=None):
+    """-> ([("quicklook_views", table)], header) for a light curve.
+
+    Instead of clips, the whole light curve is phase folded on the injected
+    ephemeris and binned into a global view of the full period and a local
+    view around the transit, giving a single row table of fixed width array
+    columns GLOBAL and LOCAL. Cadences that aren't LightCurveReport.good are
+    left out. reader and hdulist are as for gather_data.
+    """
+    if hdulist is None:
+        hdulist = open_light_curve(filename, reader)
+    with hdulist:
+        metadata, header = light_curve_metadata(hdulist, filename, header_mode)
+        kic_id = injection.parse_injected_filename(source_root(filename))
+        params = injected_index[kic_id]
+        name = hdulist[1].header["OBJECT"]
+        with timing.stage("decompress") as s:
+            data = hdulist[1].data
+            s.nbytes = data.nbytes
+        progress.note_decompressed(data.nbytes)
+        with timing.stage("validate"):
+            report = validation.validate_light_curve(data)
+        if not report.good.any():
+            logging.error("No good cadences in %s", name)
+            failures.note(failures.NO_GOOD_CADENCES)
+            return [], header
+        with timing.stage("fold"):
+            global_view, local_view = binning.phase_views(
+                data["TIME"][report.good], data["SAP_FLUX"][report.good],
+                params["i_period"], params["i_epoch"], params["i_dur"] / 24.,
+                n_global, n_local, LOCAL_DURATIONS)
+            t = table.Table([[global_view], [local_view], [params["EB_injection"]]],
+                names=("GLOBAL", "LOCAL", "EB_injection"), dtype=("f4", "f4", "i4"),
+                meta=metadata)
+    return [("quicklook_views", t)], header
+
+def make_plan(filenames, injected_index, all_transits=False, seed=0):
+    """-> Table with one row per clip to extract, made from headers only.
+
+    Only the light curve extension headers are read, the catalog lookup is
+    done for all files at once and plan_windows runs over all of them, so
+    files whose transits fall outside their light curves are never
+    decompressed. Random padding is drawn from the file_seed of each file,
+    so it doesn't depend on which other files are planned with it.
+    """
+    filenames = [path.abspath(f) for f in filenames]
+    table_start = np.full(len(filenames), np.nan)
+    table_stop = np.full(len(filenames), np.nan)
+    for i, filename in enumerate(filenames):
+        try:
+            header = fits.getheader(filename, 1)
+            table_start[i], table_stop[i] = header["TSTART"], header["TSTOP"]
+        except (OSError, KeyError) as e:
+            logging.error("Cannot read header of %s: %s", filename, e)
+    records, found = injected_index.lookup_filenames(filenames)
+    for i in np.flatnonzero(~found):
+        logging.error("No injected transit for %s", filenames[i])
+    usable = np.flatnonzero(found & np.isfinite(table_start) & np.isfinite(table_stop))
+    records = records[usable]
+    seeds = [file_seed(source_root(filenames[i]), seed) for i in usable]
+    row, num_period, start, stop, transit_start, transit_stop = plan_windows(
+        table_start[usable], table_stop[usable], records["i_epoch"],
+        records["i_period"], records["i_dur"] / 24., all_transits, seeds)
+    logging.warning("Planned %d clips from %d of %d files", len(row),
+        len(np.unique(row)), len(filenames))
+    files = np.array(filenames, dtype=str)[usable][row]
+    sizes = [path.getsize(f) for f in files]
+    label = np.where(records["EB_injection"][row], "eb", "transit")
+    return table.Table([files, records["KIC_ID"][row], num_period, start, stop,
+                        transit_start, transit_stop, label, sizes],
+        names=("FILE", "KIC_ID", "EPOCH", "START", "STOP", "TRANSIT_START",
+               "TRANSIT_STOP", "LABEL", "SIZE"),
+        meta={"all_transits": all_transits})
+
+def split_plan(plan, n):
+    """-> n plans with every file in exactly one, balanced by file size."""
+    by_file = plan.group_by("FILE")
+    sizes = by_file["SIZE"][by_file.groups.indices[:-1]]
+    parts = [(0, i, []) for i in range(n)]
+    # Largest files first, each to the part with the fewest bytes so far.
+    for g in np.argsort(sizes)[::-1]:
+        total, i, groups = heapq.heappop(parts)
+        groups.append(by_file.groups[g])
+        heapq.heappush(parts, (total + sizes[g], i, groups))
+    out = []
+    for _, i, groups in sorted(parts, key=lambda part: part[1]):
+        part = table.vstack(groups) if groups else plan[:0]
+        part.meta = plan.meta
+        out.append(part)
+    return out
+
+def load_plan(filename):
+    """-> (dictionary of file name to planned windows, all_transits)"""
+    plan = ascii.read(filename, format="ecsv")
+    windows = collections.OrderedDict()
+    for group in plan.group_by("FILE").groups:
+        windows[group["FILE"][0]] = tuple(np.array(group[c]) for c in
+            ("EPOCH", "START", "STOP", "TRANSIT_START", "TRANSIT_STOP"))
+    return windows, plan.meta.get("all_transits", False)
+
+def extraction_params(args, store=None):
+    """-> the settings that determine which clips a file produces, and the
+    ClipStore they go to, if any."""
+    return {"RANDOMIZE_BOUND": RANDOMIZE_BOUND, "BOUND_TOL": BOUND_TOL,
+            "BOUND_TOL_UPPER": BOUND_TOL_UPPER, "BOUND_TOL_LOWER": BOUND_TOL_LOWER,
+            "NEG_UPPER": NEG_UPPER, "NEG_LOWER": NEG_LOWER,
+            "NEG_MIN_COVERAGE": NEG_MIN_COVERAGE,
+            "all_transits": args.all_transits, "negatives": args.negatives,
+            "output_format": args.output_format, "header_mode": args.header_mode,
+            "plan": args.plan and journal.file_key(args.plan),
+            "target_cadence": args.target_cadence, "label_binning": args.label_binning,
+            "views": args.views and (args.global_bins, args.local_bins, LOCAL_DURATIONS),
+            "raw_pad": args.raw_pad and (args.raw_pad, RAW_NEGATIVE),
+            "policies": args.policies and [list(p) for p in args.policies],
+            "stitch": args.stitch, "seed": args.seed,
+            "catalog": journal.file_key(args.catalog), "duplicates": args.duplicates,
+            "store": None if store is None else (path.abspath(args.output), store.store_id)}
+
+def write_table(t, filename):
+    """Write an ECSV file atomically, so that a killed run never leaves a
+    truncated file behind."""
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with timing.stage("write") as s:
+            ascii.write(t, tmp, format='ecsv', overwrite=True)
+            os.replace(tmp, filename)
+            s.nbytes = path.getsize(filename)
+    finally:
+        if path.exists(tmp):
+            os.remove(tmp)
+
+def write_header(header, filename):
+    """Write a full FITS header, as dictified, to a JSON file atomically."""
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    with timing.stage("write") as s:
+        with open(tmp, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp, filename)
+        s.nbytes = path.getsize(filename)
+
+def stable_hash(name):
+    """-> integer hash of a string that is the same on every machine and run,
+    unlike hash()."""
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest()[:16], 16)
+
+def file_seed(root, seed=0):
+    """-> random seed of one light curve, so that its random padding and
+    negatives don't depend on which process or shard handles it."""
+    return stable_hash("{}:{}".format(seed, root)) % (1 << 32)
+
+def parse_shard(spec):
+    """-> (i, n) from "i/N", the i-th of N shards counting from 0."""
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shards are given as i/N, e.g. 0/4")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard {} is not in 0 to {}".format(i, n - 1))
+    return i, n
+
+def shard_name(filename, shard):
+    """-> filename with the shard number added before its extension."""
+    root, ext = path.splitext(filename)
+    return "{}.shard{}of{}{}".format(root, shard[0], shard[1], ext)
+
+def input_path(i):
+    """-> absolute path of an input file, or tuple of them if stitched."""
+    if isinstance(i, tuple):
+        return tuple(path.abspath(f) for f in i)
+    return path.abspath(i)
+
+def write_outputs(root, clips, header):
+    """Write the ECSV clips of a light curve and its header, if any."""
+    for suffix, t in clips:
+        write_table(t, root + "_" + suffix + ".ecsv")
+    if header is not None and clips:
+        write_header(header, root + "_quicklook_header.json")
+
+def prefetch(i, args, plan=None):
+    """-> light curve of an input opened and read into memory, or None if
+    a plan leaves it out, for process_file to use."""
+    filename = input_path(i)
+    if plan is not None and filename not in plan:
+        return None
+    hdulist = open_light_curve(filename, args.reader)
+    with timing.stage("decompress"):
+        if isinstance(hdulist, fitsstream.StreamedHDUList):
+            # The reader's buffers are reused by its next file.
+            hdulist[1].data = hdulist[1].data.copy()
         else:
-            neg_t = strip_cols(hdulist[1], i_neg_start, i_neg_stop, zeros, zeros, name)
-    return t, neg_t
+            hdulist[1].data
+    return hdulist
 
-def main():
-    logging.warning("Making sure that warning shots are fired")
-    # Load the injected transits data table.
-    injected = injection.parse_injected_table("/mnt/data/meta/kplr_dr25_inj1_plti.txt")
-    index = injection.index_injected_table(injected)
-    # Iterate through all filenames given as command line arguments.
-    for i in sys.argv[1:]:
-        logging.info("Processing %s", i)
+def extract_file(i, index, args, plan=None, loaded=None, write=True):
+    """-> (number of clips, clips left to write, header) of an input; see
+    process_file."""
+    filename = input_path(i)
+    # Example of an okay light curve:
+    # "/mnt/data/INJ1/kplr011183555-2011271113734_INJECTED-inj1_llc.fits.gz"
+    root = source_root(filename)
+    np.random.seed(file_seed(root, args.seed))
+    # Negatives get a stream of their own, so that they don't depend on how
+    # much padding was drawn, e.g. none when following a plan.
+    negative_rng = np.random.RandomState(file_seed(root + ":negative", args.seed))
+    windows = None
+    if plan is not None:
+        if filename not in plan:
+            logging.info("No clips planned for %s", i)
+            return 0, [], None
+        windows = plan[filename]
+    if args.views:
+        clips, header = gather_views(filename, index, args.global_bins,
+            args.local_bins, args.header_mode, args.reader, loaded)
+    else:
+        clips, header = gather_data(filename, index, args.all_transits,
+            args.negatives, args.header_mode, windows, args.target_cadence,
+            args.label_binning, args.raw_pad, args.policies, args.reader, loaded,
+            negative_rng)
+    n_clips = len(clips)
+    if args.output_format == "ecsv" and write:
+        write_outputs(root, clips, header)
+        clips, header = [], None
+    return n_clips, clips, header
+
+def process_file(i, index, args, plan=None, loaded=None, write=True):
+    """-> ((input name, status, number of clips), clips left to write, header,
+    stage timings, failure category counts, (process id, seconds, bytes
+    decompressed))
+
+    If write, ECSV clips and headers are written right away; those for the
+    HDF5 store are always handed back so that only the parent process writes
+    to it. Files missing from a plan are skipped without being opened.
+    loaded is the input as read by prefetch, or a pipeline.Failure.
+    Transient I/O errors are retried args.retries times, and a file taking
+    more than args.timeout seconds fails.
+    """
+    logging.info("Processing %s", i)
+    start = time.perf_counter()
+    for attempt in range(args.retries + 1):
         try:
-            filename = path.abspath(i)
-            # Example of an okay light curve:
-            # "/mnt/data/INJ1/kplr011183555-2011271113734_INJECTED-inj1_llc.fits.gz"
-            root = path.basename(filename).split(".")[0]
-            t, neg_t = gather_data(filename, injected, index)
-            if t is not None:
-                ascii.write(t, root + "_quicklook.ecsv", format='ecsv')
-            if neg_t is not None:
-                ascii.write(neg_t, root + "_quicklook_negative.ecsv", format='ecsv')
+            if isinstance(loaded, pipeline.Failure):
+                raise loaded.error
+            with failures.deadline(args.timeout):
+                n_clips, clips, header = extract_file(i, index, args, plan, loaded, write)
+            break
         except Exception as e:
-            logging.error("Error while processing file %s: %s", i, e)
-            logging.error("Traceback: %s", traceback.format_exc())
+            loaded = None
+            if failures.is_transient(e) and attempt < args.retries:
+                logging.warning("Retrying %s after %s", i, e)
+                time.sleep(args.retry_delay * 2 ** attempt)
+                continue
+            category = failures.category(e)
+            failures.note(category)
+            logging.error("Error (%s) while processing file %s: %s", category, i, e)
+            if category == failures.OTHER:
+                # Only unexpected errors are worth a traceback in the log.
+                logging.error("Traceback: %s", traceback.format_exc())
+            return ((i, "error", 0), [], None, timing.take(), failures.take(),
+                    (os.getpid(), time.perf_counter() - start, progress.take_decompressed()))
+    status = "ok" if n_clips else "no_clips"
+    return ((i, status, n_clips), clips, header, timing.take(), failures.take(),
+            (os.getpid(), time.perf_counter() - start, progress.take_decompressed()))
+
+class Recorder(object):
+    """Collects the result of every file, appending its clips to the store
+    and journaling it only once those clips are committed to disk. Stage
+    timings are added to stats, if given. Failure categories are counted,
+    and journaled failures are marked permanent if their category is one of
+    failures.PERMANENT. progress, if set, is updated with every file."""
+
+    def __init__(self, run_journal=None, store=None, flush_every=100, stats=None):
+        self.journal = run_journal
+        self.store = store
+        self.flush_every = flush_every
+        self.stats = stats
+        self.results = []
+        self.pending = []
+        self.failures = collections.Counter()
+        self.reasons = {}
+        self.progress = None
+
+    def add(self, result, clips, header=None, timings=None, failed=None, usage=None):
+        self.results.append(result)
+        if self.progress is not None:
+            self.progress.update(input_size(result[0]), result[1], result[2], failed, usage)
+        if failed:
+            self.failures.update(failed)
+            self.reasons[result[0]] = ",".join(sorted(failed))
+        if self.store is not None and clips:
+            # Only inputs named after a KIC ID have clips.
+            root = source_root(result[0])
+            kic_id = injection.parse_injected_filename(root)
+            with timing.stage("write") as s:
+                if header is not None:
+                    self.store.append_header(root, kic_id, header)
+                if "GLOBAL" in clips[0][1].colnames:
+                    self.store.append_views(root, kic_id, clips[0][1])
+                else:
+                    self.store.append(root, kic_id, clips)
+                s.nbytes = sum(c.nbytes for _, t in clips for c in t.columns.values())
+        if self.stats is not None:
+            timings = dict(timings or {})
+            timings.update(timing.take())
+            self.stats.add_file(timings)
+        permanent = result[1] == "error" and bool(failures.PERMANENT.intersection(failed or ()))
+        self.pending.append((result, permanent))
+        if self.store is None or len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+        if self.journal is not None:
+            for (i, status, n_clips), permanent in self.pending:
+                for f in members(i):
+                    self.journal.record(f, status, n_clips, permanent)
+        self.pending = []
+
+def init_worker(args):
+    global _worker_index, _worker_args, _worker_plan
+    if args.timing_json or args.timing_prom:
+        timing.enable()
+    if args.fits_cache:
+        fitscache.enable(args.fits_cache, args.fits_cache_gb * 1e9)
+    injected = injection.load_injected_table(args.catalog, cache=not args.no_catalog_cache)
+    _worker_index = injection.index_injected_table(injected, args.duplicates)
+    _worker_args = args
+    if args.plan:
+        _worker_plan, _ = load_plan(args.plan)
+
+def process_files_worker(chunk):
+    return [process_file(i, _worker_index, _worker_args, _worker_plan) for i in chunk]
+
+def iter_inputs(args):
+    """-> iterator over the inputs named on the command line, listed in
+    --files-from and matching --glob, which are only listed as needed."""
+    for f in args.files:
+        yield f
+    if args.files_from:
+        f = sys.stdin if args.files_from == "-" else open(args.files_from)
+        try:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    for pattern in args.glob:
+        for f in glob.iglob(pattern, recursive=True):
+            yield f
+
+def select_inputs(args):
+    """-> iterator over the inputs of this run: files or, with --stitch,
+    tuples of the files of one target, only those of --shard if given."""
+    inputs = iter_inputs(args)
+    for i in stitch.group_files(inputs) if args.stitch else inputs:
+        if args.shard and stable_hash(source_root(i)) % args.shard[1] != args.shard[0]:
+            continue
+        yield i
+
+def input_size(i):
+    """-> bytes on disk of an input file or stitched tuple of files."""
+    size = 0
+    for f in members(i):
+        try:
+            size += path.getsize(f)
+        except OSError:
+            pass  # Reported when it gets processed.
+    return size
+
+def largest_first(files):
+    """-> files sorted by size on disk, largest first, so that the slowest
+    files are not the last ones left running."""
+    sizes = [input_size(i) for i in files]
+    order = sorted(range(len(files)), key=lambda k: -sizes[k])
+    return [files[k] for k in order]
+
+def guided_chunks(files, workers):
+    """-> files split into chunks for the workers to take one at a time.
+
+    Each chunk holds about a 2 * workers th of the bytes left to hand out,
+    so chunks start out large, saving round trips, and shrink to single
+    files at the end, where a large chunk would leave the other workers idle.
+    """
+    sizes = [input_size(i) for i in files]
+    remaining = float(sum(sizes))
+    chunks, chunk, chunk_bytes = [], [], 0
+    for i, size in zip(files, sizes):
+        chunk.append(i)
+        chunk_bytes += size
+        if chunk_bytes >= remaining / (2. * workers):
+            chunks.append(chunk)
+            remaining -= chunk_bytes
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def members(i):
+    """-> list of the input files of a file or stitched tuple of files."""
+    return list(i) if isinstance(i, tuple) else [i]
+
+def write_summary(results, filename, reasons=None, failure_counts=None):
+    """Log the number of files per status and per failure category, and
+    write the per-file statuses and failure categories. Every file of a
+    stitched group gets the group's status, clip count and categories."""
+    reasons = reasons or {}
+    results = [(f, status, n_clips, reasons.get(i, "")) for i, status, n_clips in results
+               for f in members(i)]
+    counts = collections.Counter(status for _, status, _, _ in results)
+    for status, count in sorted(counts.items()):
+        logging.warning("%d file(s) finished with status %s", count, status)
+    for category, count in sorted((failure_counts or {}).items()):
+        logging.warning("%d failure(s) of category %s", count, category)
+    names, statuses, n_clips, categories = zip(*results) if results else ((), (), (), ())
+    t = table.Table([list(names), list(statuses), list(n_clips), list(categories)],
+        names=("FILE", "STATUS", "N_CLIPS", "FAILURES"), dtype=("str", "str", "i4", "str"))
+    ascii.write(t, filename, format='ecsv', overwrite=True)
+
+def run_pipeline(files, index, args, plan, recorder):
+    """Process files with reads, compute and writes overlapping, see
+    pipeline.run. A read hanging for args.timeout seconds fails the file
+    with a timeout, like its compute would."""
+
+    def write(output):
+        result, clips, header, timings, failed, usage = output
+        if args.output_format == "ecsv":
+            try:
+                write_outputs(source_root(result[0]), clips, header)
+            except Exception as e:
+                category = failures.category(e)
+                logging.error("Error (%s) while writing clips of %s: %s", category,
+                    result[0], e)
+                result = (result[0], "error", 0)
+                failed = dict(failed, **{category: failed.get(category, 0) + 1})
+            clips, header = [], None
+        recorder.add(result, clips, header, timings, failed, usage)
+
+    def read(i):
+        # The stages of a read are timed in its reader thread, and handed on
+        # with the light curve to be counted with the rest of its file.
+        try:
+            return prefetch(i, args, plan), timing.take()
+        except Exception:
+            timing.take()
+            raise
+
+    def compute(i, loaded):
+        read_timings = {}
+        if not isinstance(loaded, pipeline.Failure):
+            loaded, read_timings = loaded
+        output = process_file(i, index, args, plan, loaded, write=False)
+        return output[:3] + (timing.merge(read_timings, output[3]),) + output[4:]
+
+    pipeline.run(files, read, compute, write, args.readers, args.read_ahead,
+        args.write_behind, args.timeout)
+
+def store_bytes(clips, header=None):
+    """-> (rows, bytes) the clips of one light curve add to a ClipStore: rows
+    of the clipstore.DATA_COLUMNS, and bytes of everything else."""
+    rows = 0
+    nbytes = len(json.dumps(header)) if header is not None and clips else 0
+    for _, t in clips:
+        nbytes += len(json.dumps(t.meta))
+        if "GLOBAL" in t.colnames:
+            nbytes += sum(np.asarray(c).nbytes for c in t.columns.values())
+            continue
+        rows += len(t)
+        for name in labels.NAMES:
+            # START and STOP of every interval, and its CLIP index.
+            nbytes += 3 * 8 * len(labels.intervals(t[name]))
+    return rows, nbytes
+
+def estimate(files, index, args, plan=None):
+    """Log projections of the cost of processing files with args.
+
+    The headers of an args.estimate fraction of the files are read to count
+    the transits to clip, and args.estimate_reads of those files are
+    processed in full, without writing anything but temporary ECSV files.
+    Time and output size are projected per input byte, clip counts per file
+    and memory is the peak of this process, as it would be of a worker.
+    """
+    n = len(files)
+    if not n:
+        logging.warning("Nothing to estimate")
+        return
+    rng = np.random.RandomState(args.seed)
+    n_headers = min(n, max(args.estimate_reads, int(np.ceil(args.estimate * n))))
+    sample = [files[k] for k in rng.choice(n, n_headers, replace=False)]
+    total_bytes = sum(input_size(i) for i in files)
+    timing.enable()
+    tmp = tempfile.mkdtemp(prefix="quicklook_estimate")
+    read_bytes, seconds, open_seconds = [], [], []
+    positives = negatives = rows = hdf5_bytes = 0
+    try:
+        for i in sample[:args.estimate_reads]:
+            start = time.perf_counter()
+            try:
+                n_clips, clips, header = extract_file(i, index, args, plan, write=False)
+            except Exception as e:
+                logging.error("Error (%s) while estimating %s: %s", failures.category(e), i, e)
+                continue
+            seconds.append(time.perf_counter() - start)
+            timings = timing.take()
+            open_seconds.append(sum(timings.get(k, (0.,))[0] for k in ("open", "decompress")))
+            read_bytes.append(input_size(i))
+            negatives += sum("_negative" in suffix for suffix, _ in clips)
+            positives += sum("_negative" not in suffix for suffix, _ in clips)
+            write_outputs(path.join(tmp, source_root(i)), clips, header)
+            clip_rows, clip_bytes = store_bytes(clips, header)
+            rows += clip_rows
+            hdf5_bytes += clip_bytes
+        ecsv_bytes = sum(path.getsize(path.join(tmp, f)) for f in os.listdir(tmp))
+        empty_store = None
+        if clipstore.h5py is not None:
+            clipstore.ClipStore(path.join(tmp, "empty.h5"), "a").close()
+            empty_store = path.getsize(path.join(tmp, "empty.h5"))
+    finally:
+        shutil.rmtree(tmp)
+    if not seconds:
+        logging.error("No sampled file could be processed")
+        return
+    n_read = len(seconds)
+    # Output grows with the length of the light curves, so scale it by bytes,
+    # but the number of clips doesn't.
+    scale = total_bytes / float(max(sum(read_bytes), 1))
+    per_file = n / float(n_read)
+    planned = None
+    if not (args.stitch or args.views or plan is not None):
+        # Headers are much cheaper than full reads, so count transits on more files.
+        planned = len(make_plan(sample, index, args.all_transits, args.seed)) / float(n_headers) * n
+        planned *= sum(p.copies for p in args.policies) if args.policies else 1
+    seconds_per_byte = sum(seconds) / max(sum(read_bytes), 1)
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    lines = [
+        "Estimate for {} inputs ({:.1f} MB) from {}{} full reads:".format(
+            n, total_bytes / 1e6,
+            "" if planned is None else "{} headers and ".format(n_headers), n_read),
+        "  runtime: {} with {} worker(s), {:.0%} of it reading and decompressing".format(
+            progress.format_seconds(seconds_per_byte * total_bytes / max(args.workers, 1)),
+            max(args.workers, 1), sum(open_seconds) / sum(seconds)),
+        "  peak memory per worker: {:.0f} MB".format(peak / 1e6),
+        "  positive clips: {:.0f} (from {})".format(
+            positives * per_file if planned is None else planned,
+            "full reads" if planned is None else "headers"),
+        "  negative clips: {:.0f}".format(negatives * per_file),
+        "  ECSV output: {:.1f} MB".format(ecsv_bytes * scale / 1e6)]
+    if empty_store is not None:
+        # Column datasets grow by whole chunks.
+        chunks = np.ceil(rows * scale / clipstore.CHUNK) * clipstore.CHUNK
+        hdf5_bytes = empty_store + hdf5_bytes * scale + sum(
+            chunks * np.dtype(dtype).itemsize for _, dtype in clipstore.DATA_COLUMNS)
+        lines.append("  HDF5 output: {:.1f} MB".format(hdf5_bytes / 1e6))
+    for line in lines:
+        print(line)
+        logging.warning(line)
+
+def add_catalog_args(parser):
+    parser.add_argument("files", nargs="*", help="light curve FITS files")
+    parser.add_argument("--files-from", metavar="FILE",
+        help="also read light curve file names from FILE, one per line; - is stdin")
+    parser.add_argument("--glob", action="append", default=[], metavar="PATTERN",
+        help="also process files matching PATTERN, in which ** matches any "
+             "number of directories; can be repeated")
+    parser.add_argument("--catalog", default=INJECTED_TABLE,
+        help="IPAC table of injected transits")
+    parser.add_argument("--no-catalog-cache", action="store_true",
+        help="parse the IPAC table instead of using its binary cache")
+    parser.add_argument("--duplicates", choices=("last", "first", "error"), default="last",
+        help="which row to use for stars injected more than once")
+    parser.add_argument("--all-transits", action="store_true",
+        help="clip every fully covered transit instead of only the first")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Clip injected transits out of Kepler light curves.",
+        epilog="Run 'quicklook.py plan -h' for the header-only planning stage and "
+               "'quicklook.py merge -h' to combine the stores of shards.")
+    add_catalog_args(parser)
+    parser.add_argument("--plan",
+        help="only extract the clips of a plan written by 'quicklook.py plan'")
+    parser.add_argument("--negatives", type=int, default=1,
+        help="number of negative clips to extract per light curve")
+    parser.add_argument("--target-cadence", type=float,
+        help="bin clips of finer cadence light curves (e.g. short cadence) to "
+             "about this many minutes")
+    parser.add_argument("--label-binning", choices=("any", "fraction"), default="any",
+        help="binned labels are 1 if any cadence is labelled, or the labelled fraction")
+    parser.add_argument("--policy", dest="policy_specs", action="append", default=[],
+        metavar="SPEC",
+        help="cut clips with this window policy; can be repeated to get several "
+             "datasets in one pass. SPEC is [NAME=]fixed[:BOUND_TOL] or "
+             "[NAME=]random[:COPIES[:LOWER:UPPER]], e.g. svm=fixed lstm=random:4")
+    parser.add_argument("--policies", dest="policy_file",
+        help="JSON file with a list of window policies")
+    parser.add_argument("--raw", dest="raw_pad", nargs="?", type=float, const=RAW_PAD,
+        metavar="DAYS",
+        help="cut raw clips padded by DAYS (default %(const)s) around each transit "
+             "once, for rewindow.py to derive padded clips from")
+    parser.add_argument("--views", action="store_true",
+        help="write fixed length phase folded views of every light curve "
+             "instead of clips")
+    parser.add_argument("--global-bins", type=int, default=GLOBAL_BINS,
+        help="length of the global view")
+    parser.add_argument("--local-bins", type=int, default=LOCAL_BINS,
+        help="length of the local view")
+    parser.add_argument("--stitch", action="store_true",
+        help="stitch the quarter files of each target into one light curve, so "
+             "that clips can span quarter boundaries")
+    parser.add_argument("--reader", choices=("fits", "stream"), default="fits",
+        help="read light curves with astropy, or stream only the needed columns "
+             "while decompressing, with less memory")
+    parser.add_argument("--fits-cache",
+        help="directory to keep decompressed copies of gzipped light curves in, "
+             "for later runs to memory map")
+    parser.add_argument("--fits-cache-gb", type=float, default=20.,
+        help="size of the FITS cache, beyond which the least recently used "
+             "copies are deleted")
+    parser.add_argument("--read-ahead", type=int, default=0,
+        help="without workers, read up to this many files ahead in background "
+             "threads and write clips in another, overlapping I/O with compute")
+    parser.add_argument("--readers", type=int, default=2,
+        help="number of reader threads for --read-ahead")
+    parser.add_argument("--write-behind", type=int, default=8,
+        help="number of files whose clips may wait for the writer thread")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+        help="only process the inputs in shard i of N, chosen by a hash of their "
+             "names; the store, journal and status file get the shard in their names")
+    parser.add_argument("--seed", type=int, default=0,
+        help="base of the per light curve random seeds")
+    parser.add_argument("--estimate", nargs="?", type=float, const=0.02, metavar="FRACTION",
+        help="instead of running, sample FRACTION (default %(const)s) of the inputs and "
+             "project the runtime, memory, clips and output size of the run")
+    parser.add_argument("--estimate-reads", type=int, default=5,
+        help="number of sampled inputs to process in full for --estimate")
+    parser.add_argument("--workers", type=int, default=0,
+        help="number of worker processes; 0 processes files serially")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=1000,
+        help="replace a worker process after this many chunks of files")
+    parser.add_argument("--chunksize", type=int, default=0,
+        help="number of files handed to a worker at a time; 0 sizes chunks by "
+             "the bytes left to process")
+    parser.add_argument("--order", choices=("largest", "given"), default="largest",
+        help="process the largest files first, or in the order they are given")
+    parser.add_argument("--timeout", type=float, default=600.,
+        help="give up on a file after this many seconds; 0 waits forever. With "
+             "--read-ahead, reading and computing a file get this long each")
+    parser.add_argument("--retries", type=int, default=2,
+        help="number of times to retry a file after a transient I/O error")
+    parser.add_argument("--retry-delay", type=float, default=1.,
+        help="seconds to wait before the first retry, doubling for each next one")
+    parser.add_argument("--quarantine-after", type=int, default=3, metavar="RUNS",
+        help="skip files that failed in this many consecutive runs, or failed in a way "
+             "that can't go away (corrupt files, missing catalog entries), until they "
+             "or the parameters change; 0 never skips failures. Needs the journal")
+    parser.add_argument("--retry-quarantined", action="store_true",
+        help="process quarantined files again")
+    parser.add_argument("--journal", default="quicklook_journal.sqlite",
+        help="run journal used to skip files finished by an earlier run")
+    parser.add_argument("--no-journal", action="store_true",
+        help="process every file and do not record progress")
+    parser.add_argument("--output-format", choices=("ecsv", "hdf5"), default="ecsv",
+        help="one ECSV file per clip, or every clip in a single HDF5 store")
+    parser.add_argument("--output", default="quicklook_clips.h5",
+        help="HDF5 clip store to append to with --output-format hdf5")
+    parser.add_argument("--flush-every", type=int, default=100,
+        help="number of files between commits of the HDF5 clip store")
+    parser.add_argument("--header-mode", choices=("full", "ref"), default="full",
+        help="attach the whole FITS header to every clip, or store it once per "
+             "light curve and keep only HEADER_KEYS and a HEADER_REF on clips")
+    parser.add_argument("--timing-json",
+        help="write per-stage timing histograms of the run to this JSON file")
+    parser.add_argument("--timing-prom",
+        help="write per-stage timings in the Prometheus text format to this file")
+    parser.add_argument("--status-file", default="quicklook_status.ecsv",
+        help="where to write the per-file status summary")
+    parser.add_argument("--progress", action="store_true",
+        help="show throughput, failures and ETA on stderr while running")
+    parser.add_argument("--progress-file",
+        help="periodically write throughput, worker utilization, failures and ETA "
+             "to this JSON file")
+    parser.add_argument("--progress-interval", type=float, default=5.,
+        help="seconds between progress updates")
+    args = parser.parse_args(argv)
+    if args.label_binning == "fraction" and args.output_format == "hdf5":
+        parser.error("the HDF5 clip store only holds integer labels")
+    if args.stitch and args.plan:
+        parser.error("plans are made per file and cannot be stitched")
+    if args.shard:
+        args.output, args.journal, args.status_file = (
+            shard_name(f, args.shard) for f in (args.output, args.journal, args.status_file))
+        if args.progress_file:
+            args.progress_file = shard_name(args.progress_file, args.shard)
+    try:
+        args.policies = [parse_policy(spec) for spec in args.policy_specs]
+        if args.policy_file:
+            args.policies += load_policies(args.policy_file)
+    except ValueError as e:
+        parser.error(str(e))
+    if len(set(p.name for p in args.policies)) < len(args.policies):
+        parser.error("window policies need distinct names")
+    args.policies = args.policies or None
+    return args
+
+def plan_main(argv):
+    parser = argparse.ArgumentParser(prog="quicklook.py plan",
+        description="Plan which clips to extract using only FITS headers.")
+    add_catalog_args(parser)
+    parser.add_argument("--output", default="quicklook_plan.ecsv",
+        help="where to write the plan")
+    parser.add_argument("--split", type=int, default=1,
+        help="split the plan into this many parts of similar total file size")
+    parser.add_argument("--seed", type=int, default=0,
+        help="base of the per light curve random seeds")
+    args = parser.parse_args(argv)
+    injected = injection.load_injected_table(args.catalog, cache=not args.no_catalog_cache)
+    index = injection.index_injected_table(injected, args.duplicates)
+    plan = make_plan(list(iter_inputs(args)), index, args.all_transits, args.seed)
+    if args.split <= 1:
+        ascii.write(plan, args.output, format='ecsv', overwrite=True)
+        return
+    root, ext = path.splitext(args.output)
+    for i, part in enumerate(split_plan(plan, args.split)):
+        ascii.write(part, "{}_{}{}".format(root, i, ext), format='ecsv', overwrite=True)
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog="quicklook.py merge",
+        description="Combine the HDF5 clip stores of shards into one store.")
+    parser.add_argument("stores", nargs="+", help="HDF5 clip stores to merge")
+    parser.add_argument("--output", default="quicklook_clips.h5",
+        help="HDF5 clip store to append the shards to")
+    args = parser.parse_args(argv)
+    with clipstore.ClipStore(args.output, "a") as out:
+        merged = json.loads(out.file.attrs.get("merged", "[]"))
+        for f in args.stores:
+            key = list(journal.file_key(f))
+            if key in merged:
+                logging.warning("Already merged %s", f)
+                continue
+            with clipstore.ClipStore(f) as store:
+                out.append_store(store)
+            # Commit each shard with the record of it being merged.
+            merged.append(key)
+            out.file.attrs["merged"] = json.dumps(merged)
+            out.flush()
+        logging.warning("Merged store holds %d clips", len(out))
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["plan"]:
+        return plan_main(argv[1:])
+    if argv[:1] == ["merge"]:
+        return merge_main(argv[1:])
+    args = parse_args(argv)
+    plan = None
+    if args.plan:
+        plan, args.all_transits = load_plan(args.plan)
+        if not (args.files or args.files_from or args.glob):
+            args.files = list(plan)
+    logging.warning("Making sure that warning shots are fired")
+    if args.estimate is not None:
+        injected = injection.load_injected_table(args.catalog, cache=not args.no_catalog_cache)
+        index = injection.index_injected_table(injected, args.duplicates)
+        return estimate(list(select_inputs(args)), index, args, plan)
+    store = None
+    if args.output_format == "hdf5":
+        store = clipstore.ClipStore(args.output, "a")
+    run_journal = None
+    if not args.no_journal:
+        # Clips in a different, new or replaced store need extracting again.
+        run_journal = journal.Journal(args.journal, extraction_params(args, store))
+    stats = None
+    if args.timing_json or args.timing_prom:
+        timing.enable()
+        stats = timing.StageStats()
+    recorder = Recorder(run_journal, store, args.flush_every, stats)
+    quarantine_after = 0 if args.retry_quarantined else args.quarantine_after
+    files = []
+    # A stitched group is the unit of work, and done once all its files are.
+    for i in select_inputs(args):
+        if run_journal is not None and all(run_journal.is_done(f) for f in members(i)):
+            logging.info("Skipping %s, already done", i)
+            recorder.results.append((i, "skipped", 0))
+        elif run_journal is not None and any(
+                run_journal.is_quarantined(f, quarantine_after) for f in members(i)):
+            logging.info("Skipping %s, quarantined", i)
+            recorder.results.append((i, "quarantined", 0))
+        else:
+            files.append(i)
+    if args.order == "largest":
+        files = largest_first(files)
+    if args.progress or args.progress_file:
+        recorder.progress = progress.Progress(len(files), sum(input_size(i) for i in files),
+            args.progress, args.progress_file, args.progress_interval, args.workers)
+    try:
+        # Load the injected transits data table. This also builds or checks
+        # its cache, once, before any worker reads it.
+        injected = injection.load_injected_table(args.catalog, cache=not args.no_catalog_cache)
+        index = injection.index_injected_table(injected, args.duplicates)
+        if args.workers > 0:
+            # Each worker loads the injected transits table once on start up.
+            pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                initargs=(args,), maxtasksperchild=args.max_tasks_per_worker)
+            if args.chunksize > 0:
+                chunks = [files[k:k + args.chunksize]
+                          for k in range(0, len(files), args.chunksize)]
+            else:
+                chunks = guided_chunks(files, args.workers)
+            with pool:
+                for outputs in pool.imap_unordered(process_files_worker, chunks):
+                    for output in outputs:
+                        recorder.add(*output)
+        else:
+            if args.fits_cache:
+                fitscache.enable(args.fits_cache, args.fits_cache_gb * 1e9)
+            if args.read_ahead > 0:
+                run_pipeline(files, index, args, plan, recorder)
+            else:
+                # Iterate through all filenames given as command line arguments.
+                for i in files:
+                    recorder.add(*process_file(i, index, args, plan))
+    finally:
+        recorder.flush()
+        if recorder.progress is not None:
+            recorder.progress.close()
+        if store is not None:
+            store.close()
+        if run_journal is not None:
+            run_journal.close()
+        write_summary(recorder.results, args.status_file, recorder.reasons,
+            recorder.failures)
+        if args.timing_json:
+            stats.write_json(args.timing_json)
+        if args.timing_prom:
+            stats.write_prometheus(args.timing_prom)
 
 if __name__ == "__main__":
     logging.basicConfig(filename="output.log", level=logging.INFO)
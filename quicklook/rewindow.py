@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+import argparse
+from astropy.io import ascii
+import collections
+import logging
+import numpy as np
+from os import path
+import sys
+
+import clipstore
+import injection
+import quicklook
+import validation
+
+# Metadata of raw clips that doesn't carry over to the clips cut from them.
+RAW_KEYS = ("TRANSIT_START", "TRANSIT_STOP")
+
+def strip_raw(raw, i_start, i_stop):
+    """-> rows [i_start, i_stop) of a raw clip, without the raw metadata."""
+    t = raw[i_start:i_stop]
+    t.meta = collections.OrderedDict((k, v) for k, v in raw.meta.items() if k not in RAW_KEYS)
+    return t
+
+def rewindow(raw, randomize=None, bound_tol=None, lower=None, upper=None, name="Unknown"):
+    """-> clip padded around the transit of a raw positive clip.
+
+    The padding settings are those of quicklook.pad_transits.
+    """
+    time_col = np.asarray(raw["TIME"])
+    start, stop = quicklook.pad_transits(raw.meta["TRANSIT_START"], raw.meta["TRANSIT_STOP"],
+        randomize, bound_tol, lower, upper)
+    if start < time_col[0] or stop > time_col[-1]:
+        logging.warning("Padding reaches past the raw clip of %s", name)
+    i_start = np.searchsorted(time_col, start)
+    i_stop = np.searchsorted(time_col, stop, side="right")
+    return strip_raw(raw, i_start, i_stop)
+
+def rewindow_negative(raw, n, lower=None, upper=None, name="Unknown"):
+    """-> list of up to n non-overlapping clips cut from a raw negative clip,
+    avoiding its gaps."""
+    time_col = np.asarray(raw["TIME"])
+    if not len(time_col):
+        return []
+    gaps = validation.LightCurveReport(time_col).gaps
+    neg_start, neg_stop = quicklook.sample_negative_windows(time_col[0], time_col[-1],
+        gaps[:, 0], gaps[:, 1], n, name, lower, upper)
+    i_start = np.searchsorted(time_col, neg_start)
+    i_stop = np.searchsorted(time_col, neg_stop, side="right")
+    return [strip_raw(raw, a, b) for a, b in zip(i_start, i_stop)]
+
+def iter_raw(inputs):
+    """-> iterator of (source root, suffix, raw clip) over raw ECSV files and
+    HDF5 clip stores."""
+    for i in inputs:
+        if i.endswith(".h5"):
+            with clipstore.ClipStore(i) as store:
+                index = store.index()
+                for j, (source, suffix) in enumerate(zip(index["SOURCE"], index["SUFFIX"])):
+                    if suffix.startswith("quicklook_raw"):
+                        yield source, suffix, store.clip(j)
+        else:
+            name = path.basename(i).split(".")[0]
+            root, sep, rest = name.partition("_quicklook_raw")
+            if not sep:
+                logging.warning("Not a raw clip: %s", i)
+                continue
+            yield root, "quicklook_raw" + rest, ascii.read(i, format="ecsv")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Cut padded clips out of the raw clips of 'quicklook.py --raw'.")
+    parser.add_argument("inputs", nargs="+", help="raw ECSV clips or HDF5 clip stores")
+    parser.add_argument("--fixed", dest="randomize", action="store_false",
+        default=quicklook.RANDOMIZE_BOUND, help="pad by exactly --bound-tol")
+    parser.add_argument("--randomize", dest="randomize", action="store_true",
+        help="pad by a random amount between --bound-tol-lower and --bound-tol-upper")
+    parser.add_argument("--bound-tol", type=float, default=quicklook.BOUND_TOL)
+    parser.add_argument("--bound-tol-lower", type=float, default=quicklook.BOUND_TOL_LOWER)
+    parser.add_argument("--bound-tol-upper", type=float, default=quicklook.BOUND_TOL_UPPER)
+    parser.add_argument("--policy", dest="policy_specs", action="append", default=[],
+        metavar="SPEC",
+        help="cut clips with this window policy instead of the padding flags; "
+             "can be repeated, see 'quicklook.py --help'")
+    parser.add_argument("--policies", dest="policy_file",
+        help="JSON file with a list of window policies")
+    parser.add_argument("--neg-lower", type=float, default=quicklook.NEG_LOWER)
+    parser.add_argument("--neg-upper", type=float, default=quicklook.NEG_UPPER)
+    parser.add_argument("--negatives", type=int, default=1,
+        help="number of negative clips to cut from each raw negative clip")
+    parser.add_argument("--seed", type=int, default=0,
+        help="base of the per raw clip random seeds")
+    parser.add_argument("--outdir", default=".", help="directory for ECSV clips")
+    parser.add_argument("--output-format", choices=("ecsv", "hdf5"), default="ecsv")
+    parser.add_argument("--output", default="quicklook_clips.h5",
+        help="HDF5 clip store to append to with --output-format hdf5")
+    args = parser.parse_args(argv)
+    try:
+        args.policies = [quicklook.parse_policy(spec) for spec in args.policy_specs]
+        if args.policy_file:
+            args.policies += quicklook.load_policies(args.policy_file)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    store = None
+    if args.output_format == "hdf5":
+        store = clipstore.ClipStore(args.output, "a")
+    n_clips = 0
+    # Negatives cut so far from each light curve, which number its next ones.
+    n_negatives = collections.Counter()
+    try:
+        for root, suffix, raw in iter_raw(args.inputs):
+            name = raw.meta.get("OBJECT", root)
+            rest = suffix[len("quicklook_raw"):]
+            # Every raw clip gets its own seed, so its clips don't depend on
+            # which other raw clips are cut in the same run.
+            np.random.seed(quicklook.file_seed(root + "_" + suffix, args.seed))
+            if "_negative" in suffix:
+                clips = rewindow_negative(raw, args.negatives, args.neg_lower,
+                    args.neg_upper, name)
+                clips = [("quicklook_negative" + ("_{:02d}".format(k) if k else ""), t)
+                         for k, t in enumerate(clips, n_negatives[root])]
+                n_negatives[root] += len(clips)
+            elif args.policies:
+                clips = [(quicklook.policy_prefix(p, k) + rest,
+                          rewindow(raw, p.randomize, p.bound_tol, p.lower, p.upper, name))
+                         for p in args.policies for k in range(p.copies)]
+            else:
+                clips = [("quicklook" + rest, rewindow(raw, args.randomize, args.bound_tol,
+                    args.bound_tol_lower, args.bound_tol_upper, name))]
+            if store is not None:
+                store.append(root, injection.parse_injected_filename(root), clips)
+            else:
+                for s, t in clips:
+                    quicklook.write_table(t, path.join(args.outdir, root + "_" + s + ".ecsv"))
+            n_clips += len(clips)
+    finally:
+        if store is not None:
+            store.close()
+    logging.warning("Wrote %d clips", n_clips)
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="output.log", level=logging.INFO)
+    main()
@@ -0,0 +1,80 @@
+from astropy.io import fits
+import collections
+import numpy as np
+from os import path
+import re
+
+import injection
+
+# Columns kept in a stitched light curve, with their FITS formats.
+COLUMNS = (("TIME", "D"), ("SAP_FLUX", "D"), ("SAP_QUALITY", "J"))
+# Header cards describing the table layout, which are rebuilt rather than
+# copied from the first quarter.
+STRUCTURAL = re.compile(
+    r"^(XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|TFIELDS|T[A-Z]+\d+|\d+[A-Z]+\d+)$")
+
+def group_root(filenames):
+    """-> output name of a group of quarter files: the name of the first one
+    without its timestamp, e.g. kplr011183555_INJECTED-inj1_llc."""
+    root = path.basename(filenames[0]).split(".")[0]
+    return re.sub(r"-\d+", "", root, count=1)
+
+def group_files(filenames):
+    """-> list of tuples of the quarter files of each target, in the order
+    targets first appear. Files only group together if they have the same
+    KIC ID, cadence and injection run, i.e. the same group_root."""
+    groups = collections.OrderedDict()
+    for f in filenames:
+        groups.setdefault(group_root([f]), []).append(f)
+    return [tuple(files) for files in groups.values()]
+
+def stitch_quarters(filenames, open_file=fits.open):
+    """-> in-memory HDUList of the quarters of one target stitched into a
+    single light curve.
+
+    Each quarter's SAP_FLUX is divided by its median so that the quarters
+    line up, and rows that don't come after the previous quarter's last time
+    are dropped. The headers are those of the earliest quarter, with TSTART
+    and TSTOP spanning every quarter and STITCHED counting them. Files are
+    read with open_file, e.g. fitsstream.open_projected.
+    """
+    kic_ids = set(injection.parse_injected_filename(f) for f in filenames)
+    if len(kic_ids) > 1:
+        raise ValueError("Cannot stitch light curves of several targets: {}".format(
+            sorted(kic_ids)))
+    quarters = []
+    for f in filenames:
+        with open_file(f) as hdulist:
+            data = hdulist[1].data
+            names = data.dtype.names
+            time_col = np.array(data["TIME"], dtype=float)
+            flux = np.array(data["SAP_FLUX"], dtype=float)
+            if "SAP_QUALITY" in names:
+                quality = np.array(data["SAP_QUALITY"], dtype=np.int32)
+            else:
+                quality = np.zeros(len(time_col), dtype=np.int32)
+            finite = np.isfinite(flux)
+            if finite.any():
+                flux /= np.median(flux[finite])
+            quarters.append((hdulist[1].header["TSTART"], hdulist[1].header["TSTOP"],
+                hdulist[0].header.copy(), hdulist[1].header.copy(),
+                time_col, flux, quality))
+    quarters.sort(key=lambda q: q[0])
+    columns = [[], [], []]
+    last = -np.inf
+    for _, _, _, _, time_col, flux, quality in quarters:
+        keep = ~(time_col <= last)  # NaN times stay for validation to flag.
+        if np.isfinite(time_col).any():
+            last = max(last, np.nanmax(time_col))
+        for out, col in zip(columns, (time_col, flux, quality)):
+            out.append(col[keep])
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name=name, format=fmt,
+        array=np.concatenate(col)) for (name, fmt), col in zip(COLUMNS, columns)])
+    primary_header, header = quarters[0][2], quarters[0][3]
+    for card in header.cards:
+        if not STRUCTURAL.match(card.keyword) and card.keyword not in ("", "COMMENT", "HISTORY"):
+            hdu.header[card.keyword] = (card.value, card.comment)
+    hdu.header["TSTART"] = min(q[0] for q in quarters)
+    hdu.header["TSTOP"] = max(q[1] for q in quarters)
+    hdu.header["STITCHED"] = (len(quarters), "number of quarters stitched together")
+    return fits.HDUList([fits.PrimaryHDU(header=primary_header), hdu])
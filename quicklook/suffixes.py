@@ -0,0 +1,24 @@
+import re
+
+# Output suffixes of quicklook clips: quicklook[_raw][_POLICY][_COPY][_eEPOCH].
+# Negatives have the policy "negative" and phase folded views are
+# quicklook_views. Epochs count transits from the catalog's i_epoch, so
+# light curves taken before it have negative ones.
+# Policy names quicklook uses for clips other than padded transits.
+RESERVED = ("negative", "views", "header", "raw")
+SUFFIX = re.compile(r"^quicklook(?P<raw>_raw)?(?:_(?P<policy>.+?))??(?:_(?P<copy>\d{2,}))?"
+                    r"(?:_e(?P<epoch>-?\d{4,}))?$")
+
+def with_epoch(prefix, epoch):
+    """-> suffix of the clip of transit number epoch, e.g. quicklook_e0012
+    or quicklook_e-0003."""
+    return "{}_e{}{:04d}".format(prefix, "-" if epoch < 0 else "", abs(epoch))
+
+def split(suffix):
+    """-> (raw, policy, copy, epoch) of a clip suffix. policy is "" for the
+    default policy, copy and epoch are None when the suffix has none."""
+    m = SUFFIX.match(suffix)
+    if m is None:
+        raise ValueError("Not a quicklook clip suffix: {}".format(suffix))
+    return (bool(m.group("raw")), m.group("policy") or "",
+            m.group("copy") and int(m.group("copy")), m.group("epoch") and int(m.group("epoch")))
@@ -0,0 +1,49 @@
+from astropy import table
+from astropy.io import ascii, fits
+import functools
+import numpy as np
+import os
+import sys
+
+import pytest
+
+# The quicklook modules import each other as top level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CADENCE = 0.0204  # day; Kepler long cadence.
+
+def write_light_curve(directory, kic_id, start=100., stop=130., gaps=()):
+    """-> path of a gzipped long cadence light curve of KIC kic_id with flat
+    flux and no cadences inside the (start, stop) gaps."""
+    time = np.arange(start, stop, CADENCE)
+    for a, b in gaps:
+        time = time[(time < a) | (time > b)]
+    columns = [fits.Column(name="TIME", format="D", array=time),
+               fits.Column(name="SAP_FLUX", format="E", array=np.full(len(time), 1e4)),
+               fits.Column(name="SAP_QUALITY", format="J", array=np.zeros(len(time)))]
+    hdu = fits.BinTableHDU.from_columns(columns)
+    hdu.header["TSTART"] = time[0]
+    hdu.header["TSTOP"] = time[-1]
+    hdu.header["OBJECT"] = "KIC {}".format(kic_id)
+    primary = fits.PrimaryHDU()
+    primary.header["KEPLERID"] = kic_id
+    filename = os.path.join(str(directory),
+        "kplr{:09d}-2011271113734_INJECTED-inj1_llc.fits.gz".format(kic_id))
+    fits.HDUList([primary, hdu]).writeto(filename)
+    return filename
+
+def write_catalog(filename, rows):
+    """-> filename of an IPAC injected transits table of (KIC_ID, i_epoch,
+    i_period, i_dur in hours, EB_injection) rows."""
+    t = table.Table(rows=rows, names=("KIC_ID", "i_epoch", "i_period", "i_dur", "EB_injection"),
+                    dtype=("i8", "f8", "f8", "f8", "i4"))
+    ascii.write(t, str(filename), format="ipac", overwrite=True)
+    return str(filename)
+
+@pytest.fixture
+def light_curve(tmp_path):
+    return functools.partial(write_light_curve, tmp_path)
+
+@pytest.fixture
+def catalog(tmp_path):
+    return functools.partial(write_catalog, tmp_path / "catalog.txt")
@@ -0,0 +1,117 @@
+from astropy import table
+import numpy as np
+import pytest
+
+import clipstore
+
+pytest.importorskip("h5py")
+
+def clip(n, transit=(), eb=(), start=0.):
+    in_transit = np.zeros(n, dtype="i4")
+    for a, b in transit:
+        in_transit[a:b] = 1
+    eb_injection = np.zeros(n, dtype="i4")
+    for a, b in eb:
+        eb_injection[a:b] = 1
+    return table.Table([start + np.arange(n) * 0.02, np.full(n, 1e4), in_transit, eb_injection],
+        names=[name for name, _ in clipstore.COLUMNS], meta={"OBJECT": "KIC 1"})
+
+def assert_same(a, b):
+    for name, _ in clipstore.COLUMNS:
+        assert np.array_equal(np.asarray(a[name]), np.asarray(b[name]))
+    assert dict(a.meta) == dict(b.meta)
+
+def test_clip_round_trip(tmp_path):
+    clips = [("quicklook_e0001", clip(50, [(10, 20)])),
+             ("quicklook_e0002", clip(30, [(0, 5), (25, 30)])), ("quicklook_negative", clip(40))]
+    with clipstore.ClipStore(str(tmp_path / "c.h5"), "a") as store:
+        store.append("lc", 1, clips)
+        store.append("eb", 2, [("quicklook", clip(20, eb=[(3, 9)]))])
+    store = clipstore.ClipStore(str(tmp_path / "c.h5"))
+    assert len(store) == 4
+    for k, (_, t) in enumerate(clips):
+        assert_same(store.clip(k), t)
+    assert [len(c) for c in store.split_column("TIME")] == [50, 30, 40, 20]
+
+def test_uncommitted_clips_are_dropped(tmp_path):
+    filename = str(tmp_path / "c.h5")
+    store = clipstore.ClipStore(filename, "a")
+    store.append("lc", 1, [("quicklook", clip(10, [(2, 4)]))])
+    store.flush()
+    store.append("lc", 1, [("quicklook_negative", clip(15, [(1, 3)]))])
+    store.append_header("lc", 1, {"OBJECT": "KIC 1"})
+    store.file.flush()
+    reader = clipstore.ClipStore(filename)
+    assert len(reader) == 1
+    assert len(reader.index()) == 1
+    assert [len(c) for c in reader.split_column("SAP_FLUX")] == [10]
+    assert [c.sum() for c in reader.split_column("IN_TRANSIT")] == [2]
+    assert reader.header("lc") is None
+    reader.close()
+    store.file.close()  # Killed without committing.
+    store = clipstore.ClipStore(filename, "a")
+    assert len(store) == 1
+    store.append("lc", 1, [("quicklook_negative", clip(5))])
+    store.close()
+    store = clipstore.ClipStore(filename)
+    assert len(store) == 2
+    assert store.split_column("IN_TRANSIT")[1].sum() == 0
+
+def test_headers_are_stored_once(tmp_path):
+    filename = str(tmp_path / "c.h5")
+    with clipstore.ClipStore(filename, "a") as store:
+        store.append_header("lc", 1, {"OBJECT": "KIC 1", "EMPTY": None})
+        store.append("lc", 1, [("quicklook", clip(5))])
+    with clipstore.ClipStore(filename) as store:
+        assert store.header("lc") == {"OBJECT": "KIC 1", "EMPTY": None}
+        assert store.header("other") is None
+
+def test_append_store_merges(tmp_path):
+    parts = []
+    for k in range(2):
+        filename = str(tmp_path / "part{}.h5".format(k))
+        with clipstore.ClipStore(filename, "a") as store:
+            store.append("lc{}".format(k), k, [("quicklook", clip(10 + k, [(k, k + 3)]))])
+            store.append_header("lc{}".format(k), k, {"PART": k})
+        parts.append(filename)
+    with clipstore.ClipStore(str(tmp_path / "merged.h5"), "a") as merged:
+        for filename in parts:
+            with clipstore.ClipStore(filename) as part:
+                merged.append_store(part)
+    merged = clipstore.ClipStore(str(tmp_path / "merged.h5"))
+    assert list(merged.index()["SOURCE"]) == ["lc0", "lc1"]
+    assert merged.label_intervals(1, "IN_TRANSIT").tolist() == [[1, 4]]
+    assert len(merged.column(1, "TIME")) == 11
+    assert merged.header("lc1") == {"PART": 1}
+
+def test_labels_are_stored_as_intervals(tmp_path):
+    filename = str(tmp_path / "c.h5")
+    with clipstore.ClipStore(filename, "a") as store:
+        store.append("lc", 1, [("quicklook_e0001", clip(50, [(10, 20)])),
+                               ("quicklook_e0002", clip(30, [(0, 5), (25, 30)])),
+                               ("quicklook_negative", clip(40))])
+        store.append("eb", 2, [("quicklook", clip(20, eb=[(3, 9)]))])
+    store = clipstore.ClipStore(filename)
+    assert "IN_TRANSIT" not in store.file["clips"]
+    assert len(store.file["labels/IN_TRANSIT/CLIP"]) == 3
+    assert store.label_intervals(1, "IN_TRANSIT").tolist() == [[0, 5], [25, 30]]
+    assert store.label_intervals(2, "IN_TRANSIT").shape == (0, 2)
+    assert store.label_intervals(3, "EB_injection").tolist() == [[3, 9]]
+    dense = store.split_column("IN_TRANSIT")
+    assert [d.sum() for d in dense] == [10, 10, 0, 0]
+    for d, p in zip(dense, store.split_column("IN_TRANSIT", packed=True)):
+        assert np.array_equal(np.unpackbits(p)[:len(d)], d)
+
+def test_uncommitted_intervals_are_dropped(tmp_path):
+    filename = str(tmp_path / "c.h5")
+    store = clipstore.ClipStore(filename, "a")
+    store.append("lc", 1, [("quicklook", clip(10, [(2, 4)]))])
+    store.flush()
+    store.append("lc", 1, [("quicklook_e0002", clip(15, [(1, 3)]))])
+    store.file.close()  # Killed without committing.
+    store = clipstore.ClipStore(filename, "a")
+    assert len(store.file["labels/IN_TRANSIT/CLIP"]) == 1
+    store.append("lc", 1, [("quicklook_negative", clip(5))])
+    store.close()
+    with clipstore.ClipStore(filename) as store:
+        assert [d.sum() for d in store.split_column("IN_TRANSIT")] == [2, 0]
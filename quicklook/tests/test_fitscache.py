@@ -0,0 +1,85 @@
+import gzip
+import os
+
+import fitscache
+import quicklook
+
+def gzipped(tmp_path, name, size):
+    filename = str(tmp_path / (name + ".fits.gz"))
+    with gzip.open(filename, "wb") as f:
+        f.write(os.urandom(size))
+    return filename
+
+def age(filename, seconds):
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime - seconds, stat.st_mtime - seconds))
+
+def test_copies_are_reused(tmp_path):
+    cache = fitscache.FitsCache(str(tmp_path / "cache"), 1e6)
+    source = gzipped(tmp_path, "a", 1000)
+    copy = cache.get(source)
+    with open(copy, "rb") as f, gzip.open(source) as g:
+        assert f.read() == g.read()
+    assert cache.get(source) == copy
+    assert (cache.hits, cache.misses) == (1, 1)
+    # A changed source gets a new copy.
+    age(source, 10)
+    assert cache.get(source) != copy
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = fitscache.FitsCache(str(tmp_path / "cache"), 3500)
+    copies = []
+    for k, name in enumerate("abc"):
+        copies.append(cache.get(gzipped(tmp_path, name, 1000)))
+        age(copies[-1], 100 - k)
+    # Using a makes b the least recently used.
+    cache.get(str(tmp_path / "a.fits.gz"))
+    d = cache.get(gzipped(tmp_path, "d", 1000))
+    assert [os.path.exists(c) for c in copies + [d]] == [True, False, True, True]
+    assert cache.total == 3000
+
+def test_evicts_down_to_low_water(tmp_path):
+    cache = fitscache.FitsCache(str(tmp_path / "cache"), 4000)
+    copies = []
+    for k in range(5):
+        copies.append(cache.get(gzipped(tmp_path, str(k), 1000)))
+        age(copies[-1], 100 - k)
+    assert cache.total <= fitscache.LOW_WATER * 4000
+    assert [os.path.exists(c) for c in copies] == [False, False, True, True, True]
+
+def test_copy_handed_out_is_kept(tmp_path):
+    cache = fitscache.FitsCache(str(tmp_path / "cache"), 500)
+    big = cache.get(gzipped(tmp_path, "big", 1000))
+    assert os.path.exists(big)
+    age(big, 100)
+    other = cache.get(gzipped(tmp_path, "other", 1000))
+    assert os.path.exists(other) and not os.path.exists(big)
+
+def test_scans_only_when_over_budget(tmp_path, monkeypatch):
+    cache = fitscache.FitsCache(str(tmp_path / "cache"), 1e6)
+    scans = []
+    scan = cache.scan
+    monkeypatch.setattr(cache, "scan", lambda: scans.append(1) or scan())
+    for k in range(20):
+        cache.get(gzipped(tmp_path, str(k), 1000))
+    assert len(scans) == 1
+    assert cache.total == 20000
+
+def test_open_file_remakes_an_evicted_copy(tmp_path, light_curve, monkeypatch):
+    filename = light_curve(1)
+    monkeypatch.setattr(fitscache, "_cache", fitscache.FitsCache(str(tmp_path / "cache"), 1e9))
+    get = fitscache._cache.get
+    calls = []
+
+    def evicted_right_away(f):
+        copy = get(f)
+        if not calls:
+            os.remove(copy)  # As if by another worker.
+        calls.append(copy)
+        return copy
+    monkeypatch.setattr(fitscache._cache, "get", evicted_right_away)
+    for reader in ("fits", "stream"):
+        del calls[:]
+        with quicklook.open_file(filename, reader) as hdulist:
+            assert len(hdulist[1].data["TIME"]) > 0
+        assert len(calls) == 2
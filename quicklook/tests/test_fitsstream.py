@@ -0,0 +1,88 @@
+from astropy.io import fits
+import gzip
+import numpy as np
+import os
+import pytest
+
+import fitsstream
+import stitch
+
+def write_table(filename, n=5000):
+    rng = np.random.RandomState(0)
+    columns = [fits.Column(name="TIME", format="D", array=np.arange(n) * 0.02),
+               fits.Column(name="TIMECORR", format="E", array=rng.uniform(size=n)),
+               fits.Column(name="CADENCENO", format="J", array=np.arange(n)),
+               fits.Column(name="SAP_FLUX", format="E", array=rng.normal(1e4, 10, n)),
+               fits.Column(name="FLAGS", format="3X", array=np.zeros((n, 3), dtype=bool)),
+               fits.Column(name="SAP_QUALITY", format="J", array=rng.randint(0, 4, n))]
+    hdu = fits.BinTableHDU.from_columns(columns)
+    hdu.header["TSTART"] = 0.
+    fits.HDUList([fits.PrimaryHDU(np.zeros((3, 4), dtype=np.int16)), hdu]).writeto(filename)
+    return filename
+
+def test_row_dtype_offsets(tmp_path):
+    header = fits.getheader(write_table(str(tmp_path / "lc.fits")), 1)
+    dtype = fitsstream.row_dtype(header, ("TIME", "SAP_FLUX", "SAP_QUALITY", "MISSING"))
+    assert dtype.names == ("TIME", "SAP_FLUX", "SAP_QUALITY")
+    assert dtype.itemsize == header["NAXIS1"]
+    # TIME D, TIMECORR E, CADENCENO J, SAP_FLUX E, FLAGS 3X (1 byte), SAP_QUALITY J
+    assert [dtype.fields[n][1] for n in dtype.names] == [0, 16, 21]
+
+def test_row_dtype_rejects_scaled_columns():
+    header = fits.Header([("TFIELDS", 1), ("TFORM1", "J"), ("TTYPE1", "SAP_FLUX"),
+                          ("TSCAL1", 2.), ("NAXIS1", 4)])
+    with pytest.raises(ValueError):
+        fitsstream.row_dtype(header, ("SAP_FLUX",))
+
+def test_data_size_pads_to_blocks():
+    header = fits.Header([("BITPIX", 16), ("NAXIS", 2), ("NAXIS1", 3), ("NAXIS2", 4)])
+    assert fitsstream.data_size(header) == fitsstream.BLOCK
+    header = fits.Header([("BITPIX", 8), ("NAXIS", 2), ("NAXIS1", 2880), ("NAXIS2", 2),
+                          ("PCOUNT", 10), ("GCOUNT", 1)])
+    assert fitsstream.data_size(header) == 3 * fitsstream.BLOCK
+    assert fitsstream.data_size(fits.Header([("BITPIX", 8), ("NAXIS", 0)])) == 0
+
+@pytest.mark.parametrize("gzipped", (False, True))
+def test_stream_reader_matches_astropy(tmp_path, gzipped):
+    filename = write_table(str(tmp_path / "lc.fits"))
+    if gzipped:
+        with open(filename, "rb") as src, gzip.open(filename + ".gz", "wb") as dst:
+            dst.write(src.read())
+        filename += ".gz"
+    hdus = fitsstream.StreamReader(chunk_rows=1000).read(filename)
+    with fits.open(filename) as expected:
+        assert hdus[1].header["TSTART"] == 0.
+        for name in fitsstream.COLUMNS:
+            assert np.array_equal(hdus[1].data[name], expected[1].data[name])
+
+def test_truncated_files_raise_eof(tmp_path):
+    filename = write_table(str(tmp_path / "lc.fits"))
+    with open(filename, "rb") as f:
+        data = f.read()
+    for size in (1000, 2 * fitsstream.BLOCK + 100, len(data) - 5000):
+        with open(filename, "wb") as f:
+            f.write(data[:size])
+        with pytest.raises(EOFError):
+            fitsstream.StreamReader().read(filename)
+
+def test_buffers_are_reused_across_files(tmp_path):
+    reader = fitsstream.StreamReader(chunk_rows=100)
+    small = reader.read(write_table(str(tmp_path / "small.fits"), 300))[1].data
+    assert len(small) == 300
+    large = reader.read(write_table(str(tmp_path / "large.fits"), 700))[1].data
+    with fits.open(str(tmp_path / "large.fits")) as expected:
+        assert np.array_equal(large["SAP_FLUX"], expected[1].data["SAP_FLUX"])
+    assert len(reader.read(str(tmp_path / "small.fits"))[1].data) == 300
+
+def test_stitching_streamed_quarters(tmp_path, light_curve):
+    quarters = []
+    for k, start in enumerate((100., 120.)):
+        filename = light_curve(3, start, start + 15.)
+        quarter = filename.replace("2011271113734", "20112711137{:02d}".format(k))
+        os.rename(filename, quarter)
+        quarters.append(quarter)
+    streamed = stitch.stitch_quarters(quarters, fitsstream.open_projected)
+    expected = stitch.stitch_quarters(quarters)
+    for name in ("TIME", "SAP_FLUX", "SAP_QUALITY"):
+        assert np.array_equal(streamed[1].data[name], expected[1].data[name])
+    assert streamed[1].header["STITCHED"] == 2
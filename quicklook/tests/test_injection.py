@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+import injection
+
+ROWS = [(1, 100.5, 3., 2., 0), (2, 101.5, 4., 3., 1)]
+
+def test_cache_is_built_and_reused(catalog):
+    filename = catalog(ROWS)
+    injected = injection.load_injected_table(filename)
+    assert list(injected["KIC_ID"]) == [1, 2]
+    assert isinstance(injected["i_epoch"], np.memmap)
+    assert injection.cache_is_fresh(filename, filename + ".cache", injection.CACHED_COLUMNS)
+
+def test_cache_is_rebuilt_when_the_table_changes(catalog):
+    filename = catalog(ROWS)
+    injection.load_injected_table(filename)
+    catalog(ROWS + [(3, 102.5, 5., 4., 0)])
+    assert not injection.cache_is_fresh(filename, filename + ".cache",
+                                        injection.CACHED_COLUMNS)
+    assert list(injection.load_injected_table(filename)["KIC_ID"]) == [1, 2, 3]
+
+def test_touched_table_is_hashed_not_rebuilt(catalog):
+    filename = catalog(ROWS)
+    injection.load_injected_table(filename)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert injection.cache_is_fresh(filename, filename + ".cache", injection.CACHED_COLUMNS)
+
+def test_missing_or_broken_cache_is_rebuilt(catalog):
+    filename = catalog(ROWS)
+    injection.load_injected_table(filename)
+    os.remove(os.path.join(filename + ".cache", "i_dur.npy"))
+    assert list(injection.load_injected_table(filename)["i_dur"]) == [2., 3.]
+    with open(os.path.join(filename + ".cache", "source.json"), "w") as f:
+        f.write("{")
+    assert list(injection.load_injected_table(filename)["i_dur"]) == [2., 3.]
+
+def test_unwritable_cache_falls_back_to_parsing(catalog, monkeypatch):
+    filename = catalog(ROWS)
+
+    def fail(*args):
+        raise PermissionError("read only")
+    monkeypatch.setattr(injection.os, "makedirs", fail)
+    injected = injection.load_injected_table(filename)
+    assert list(injected["KIC_ID"]) == [1, 2]
+    assert not os.path.exists(filename + ".cache")
+
+def table(kic_ids):
+    n = len(kic_ids)
+    return {"KIC_ID": np.array(kic_ids), "i_epoch": np.arange(n, dtype=float),
+            "i_period": np.ones(n), "i_dur": np.ones(n), "EB_injection": np.zeros(n, dtype=int)}
+
+def test_index_looks_up_rows():
+    index = injection.InjectedIndex(table([30, 10, 20]))
+    assert len(index) == 3
+    assert index[20]["i_epoch"] == 2. and index[20]["ROW"] == 2
+    assert 10 in index and 15 not in index
+    records, found = index.lookup([20, 15, 40, 10])
+    assert found.tolist() == [True, False, False, True]
+    assert records["ROW"].tolist() == [2, 0, 0, 1]
+    assert records["KIC_ID"].tolist() == [20, 15, 40, 10]
+
+def test_missing_entry():
+    index = injection.InjectedIndex(table([1]))
+    with pytest.raises(injection.MissingEntry):
+        index[2]
+    assert not injection.InjectedIndex(table([])).lookup([1])[1].any()
+
+def test_duplicate_policies():
+    injected = table([5, 7, 5, 5])
+    assert injection.InjectedIndex(injected)[5]["ROW"] == 3
+    assert injection.InjectedIndex(injected, "last")[5]["ROW"] == 3
+    assert injection.InjectedIndex(injected, "first")[5]["ROW"] == 0
+    assert len(injection.InjectedIndex(injected, "first")) == 2
+    with pytest.raises(ValueError):
+        injection.InjectedIndex(injected, "error")
+    assert len(injection.InjectedIndex(table([5, 7]), "error")) == 2
+    with pytest.raises(ValueError):
+        injection.InjectedIndex(injected, "middle")
+
+def test_parse_injected_filename():
+    assert injection.parse_injected_filename(
+        "/data/kplr011183555-2011271113734_INJECTED-inj1_llc.fits.gz") == 11183555
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+
+import pytest
+
+import clipstore
+import journal
+import quicklook
+
+def test_done_only_for_same_file_and_params(tmp_path):
+    f = tmp_path / "a.fits"
+    f.write_bytes(b"x")
+    j = journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 0})
+    assert not j.is_done(str(f))
+    j.record(str(f), "ok", 3)
+    assert j.is_done(str(f))
+    j.close()
+    # A later run with the same parameters trusts it.
+    assert journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 0}).is_done(str(f))
+    assert not journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 1}).is_done(str(f))
+    stat = os.stat(str(f))
+    os.utime(str(f), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 0}).is_done(str(f))
+
+def test_errors_are_not_done(tmp_path):
+    f = tmp_path / "a.fits"
+    f.write_bytes(b"x")
+    j = journal.Journal(str(tmp_path / "j.sqlite"), {})
+    j.record(str(f), "error", 0)
+    assert not j.is_done(str(f))
+    j.record(str(f), "no_clips", 0)
+    assert j.is_done(str(f))
+
+def run(tmp_path, files, catalog, *options):
+    quicklook.main(files + ["--catalog", catalog, "--journal", str(tmp_path / "j.sqlite"),
+                            "--status-file", str(tmp_path / "status.ecsv")] + list(options))
+
+def test_resume_refills_other_or_replaced_store(tmp_path, light_curve, catalog, monkeypatch):
+    pytest.importorskip("h5py")
+    monkeypatch.chdir(tmp_path)
+    files = [light_curve(1), light_curve(2)]
+    cat = catalog([(1, 103., 10., 5., 0), (2, 104., 10., 5., 0)])
+    for store in ("a.h5", "b.h5", "a.h5"):
+        run(tmp_path, files, cat, "--output-format", "hdf5", "--output", store)
+    with clipstore.ClipStore("a.h5") as a, clipstore.ClipStore("b.h5") as b:
+        assert len(a) == len(b) == 4
+    os.remove("b.h5")
+    run(tmp_path, files, cat, "--output-format", "hdf5", "--output", "b.h5")
+    with clipstore.ClipStore("b.h5") as b:
+        assert len(b) == 4
+    # The same store is not appended to twice.
+    run(tmp_path, files, cat, "--output-format", "hdf5", "--output", "b.h5")
+    with clipstore.ClipStore("b.h5") as b:
+        assert len(b) == 4
+
+def test_old_journals_are_migrated(tmp_path):
+    f = tmp_path / "a.fits"
+    f.write_bytes(b"x")
+    conn = sqlite3.connect(str(tmp_path / "j.sqlite"))
+    conn.execute("CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                 "params TEXT, status TEXT, n_clips INTEGER, updated REAL)")
+    conn.execute("INSERT INTO files VALUES (?, ?, ?, ?, 'ok', 1, 0)",
+                 journal.file_key(str(f)) + ('{"seed": 0}',))
+    conn.commit()
+    conn.close()
+    j = journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 0})
+    assert j.is_done(str(f))
+    j.record(str(f), "ok", 1)
+    j.close()
+    other = journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 1})
+    other.record(str(f), "ok", 2)
+    assert journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 0}).is_done(str(f))
+
+def test_quarantine_after_repeated_failures(tmp_path):
+    f = tmp_path / "a.fits"
+    f.write_bytes(b"x")
+    j = journal.Journal(str(tmp_path / "j.sqlite"), {})
+    for runs in range(1, 4):
+        j.record(str(f), "error", 0)
+        assert j.is_quarantined(str(f), 3) == (runs == 3)
+    assert not j.is_quarantined(str(f), 0)
+    assert not j.is_quarantined(str(f), 4)
+    # Succeeding starts the count again.
+    j.record(str(f), "ok", 1)
+    j.record(str(f), "error", 0)
+    assert not j.is_quarantined(str(f), 2)
+
+def test_permanent_failures_are_quarantined_until_the_file_changes(tmp_path):
+    f = tmp_path / "a.fits"
+    f.write_bytes(b"x")
+    j = journal.Journal(str(tmp_path / "j.sqlite"), {})
+    j.record(str(f), "error", 0, permanent=True)
+    assert j.is_quarantined(str(f), 3)
+    assert not j.is_quarantined(str(f), 0)
+    f.write_bytes(b"xy")
+    assert not j.is_quarantined(str(f), 3)
+    assert not journal.Journal(str(tmp_path / "j.sqlite"), {"seed": 1}).is_quarantined(
+        str(f), 3)
+
+def test_runs_skip_quarantined_files(tmp_path, light_curve, catalog, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = [light_curve(1), light_curve(2)]
+    cat = catalog([(1, 103., 10., 5., 0)])  # No entry for KIC 2.
+    statuses = []
+    for options in ([], [], ["--retry-quarantined"]):
+        run(tmp_path, files, cat, "--order", "given", *options)
+        status = quicklook.ascii.read(str(tmp_path / "status.ecsv"), format="ecsv")
+        statuses.append(list(status["STATUS"]))
+    assert statuses == [["ok", "error"], ["skipped", "quarantined"], ["skipped", "error"]]
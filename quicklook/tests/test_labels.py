@@ -0,0 +1,28 @@
+import numpy as np
+
+import labels
+
+def test_intervals_of_mask():
+    mask = np.array([1, 1, 0, 0, 1, 0, 1, 1, 1])
+    assert labels.intervals(mask).tolist() == [[0, 2], [4, 5], [6, 9]]
+    assert labels.intervals(np.zeros(5)).shape == (0, 2)
+    assert labels.intervals(np.zeros(0)).shape == (0, 2)
+
+def test_dense_round_trip():
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        mask = (rng.uniform(size=rng.randint(1, 200)) < 0.3).astype("i4")
+        assert np.array_equal(labels.dense(labels.intervals(mask), len(mask)), mask)
+
+def test_packed_round_trip():
+    mask = np.zeros(13, dtype=bool)
+    mask[3:11] = True
+    packed = labels.packed(labels.intervals(mask), len(mask))
+    assert len(packed) == 2
+    assert np.array_equal(np.unpackbits(packed)[:13].astype(bool), mask)
+
+def test_clip_intervals_are_relative_and_clipped():
+    spans = labels.clip_intervals([2, 10, 30], [5, 20, 40], 4, 15)
+    assert spans.tolist() == [[0, 1], [6, 11]]
+    assert labels.clip_intervals([], [], 0, 10).shape == (0, 2)
+    assert labels.clip_intervals(50, 60, 0, 10).shape == (0, 2)
@@ -0,0 +1,137 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import pipeline
+import quicklook
+import timing
+
+def settle(baseline, timeout=2.):
+    """-> whether the threads started since baseline have all finished."""
+    deadline = time.time() + timeout
+    while threading.active_count() > baseline and time.time() < deadline:
+        time.sleep(0.01)
+    return threading.active_count() <= baseline
+
+def test_every_item_is_read_computed_and_written():
+    written = []
+    pipeline.run(range(50), lambda i: i * 2, lambda i, x: (i, x + 1), written.append,
+                 readers=3, read_ahead=2, write_behind=2)
+    assert sorted(written) == [(i, 2 * i + 1) for i in range(50)]
+
+def test_failed_reads_are_handed_to_compute():
+    def read(i):
+        if i == 3:
+            raise OSError("bad read")
+        return i
+
+    def compute(i, loaded):
+        return (i, str(loaded.error) if isinstance(loaded, pipeline.Failure) else loaded)
+    written = []
+    pipeline.run(range(5), read, compute, written.append)
+    assert sorted(written) == [(0, 0), (1, 1), (2, 2), (3, "bad read"), (4, 4)]
+
+def test_compute_errors_stop_the_pipeline_after_writing_what_was_computed():
+    baseline = threading.active_count()
+    read = []
+    written = []
+
+    def compute(i, loaded):
+        if i == 5:
+            raise ValueError("bad compute")
+        return i
+    with pytest.raises(ValueError):
+        pipeline.run(itertools.count(), lambda i: read.append(i) or i, compute,
+                     written.append, readers=1, read_ahead=2)
+    assert settle(baseline)
+    assert sorted(written) == [0, 1, 2, 3, 4]
+    assert len(read) < 20  # Reading stopped instead of going on forever.
+
+def test_write_errors_stop_the_pipeline():
+    baseline = threading.active_count()
+    computed = []
+
+    def write(i):
+        if i == 2:
+            raise OSError("disk full")
+    with pytest.raises(OSError):
+        pipeline.run(itertools.count(), lambda i: i, lambda i, x: computed.append(i) or i,
+                     write, read_ahead=2, write_behind=2)
+    assert settle(baseline)
+    assert len(computed) < 20
+
+def test_reads_ahead_are_bounded():
+    lock = threading.Lock()
+    pending = [0, 0]  # Read but not yet computed, most ever.
+
+    def read(i):
+        with lock:
+            pending[0] += 1
+            pending[1] = max(pending)
+        return i
+
+    def compute(i, loaded):
+        time.sleep(0.002)
+        with lock:
+            pending[0] -= 1
+    pipeline.run(range(100), read, compute, lambda x: None, readers=2, read_ahead=3)
+    # The queue, one read per reader waiting to go in and the one being computed.
+    assert pending[1] <= 3 + 2 + 1
+
+def test_read_ahead_stage_timings_count_every_file(tmp_path, light_curve, catalog,
+                                                   monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(timing, "_enabled", timing._enabled)
+    files = [light_curve(k) for k in (1, 2, 3)]
+    cat = catalog([(k, 103., 10., 5., 0) for k in (1, 2, 3)])
+    quicklook.main(files + ["--catalog", cat, "--read-ahead", "2", "--readers", "2",
+                            "--no-journal", "--timing-json", "timing.json"])
+    with open("timing.json") as f:
+        stages = json.load(f)
+    assert stages["open"]["files"] == 3
+    assert stages["open"]["bytes"] == sum(os.path.getsize(f) for f in files)
+    assert stages["write"]["files"] == 3
+
+def test_hung_reads_time_out():
+    release = threading.Event()
+
+    def read(i):
+        if i == 2:
+            release.wait(10)
+        return i
+
+    def compute(i, loaded):
+        return (i, type(loaded.error) if isinstance(loaded, pipeline.Failure) else loaded)
+    written = []
+    start = time.monotonic()
+    try:
+        pipeline.run(range(6), read, compute, written.append, readers=2, read_timeout=0.3)
+    finally:
+        release.set()
+    assert time.monotonic() - start < 5
+    assert sorted(written) == [(0, 0), (1, 1), (2, TimeoutError), (3, 3), (4, 4), (5, 5)]
+
+def test_timed_out_reads_count_as_timeouts(tmp_path, light_curve, catalog, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = [light_curve(k) for k in (1, 2)]
+    cat = catalog([(k, 103., 10., 5., 0) for k in (1, 2)])
+    prefetch = quicklook.prefetch
+    release = threading.Event()
+
+    def hang_on_first(i, args, plan=None):
+        if i == files[0]:
+            release.wait(10)
+        return prefetch(i, args, plan)
+    monkeypatch.setattr(quicklook, "prefetch", hang_on_first)
+    try:
+        quicklook.main(files + ["--catalog", cat, "--read-ahead", "2", "--timeout", "0.5",
+                                "--order", "given", "--no-journal"])
+    finally:
+        release.set()
+    status = quicklook.ascii.read("quicklook_status.ecsv", format="ecsv")
+    assert dict(zip(status["FILE"], status["STATUS"])) == {files[0]: "error", files[1]: "ok"}
+    assert dict(zip(status["FILE"], status["FAILURES"]))[files[0]] == "timeout"
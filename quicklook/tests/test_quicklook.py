@@ -0,0 +1,246 @@
+import numpy as np
+import pytest
+
+import failures
+import injection
+import quicklook
+import suffixes
+
+def index(*rows):
+    """-> InjectedIndex of (KIC_ID, i_epoch, i_period, i_dur in hours[,
+    EB_injection]) rows."""
+    rows = [tuple(row) + (0,) * (5 - len(row)) for row in rows]
+    return injection.InjectedIndex(dict(zip(
+        ("KIC_ID", "i_epoch", "i_period", "i_dur", "EB_injection"),
+        (np.array(c) for c in zip(*rows)))))
+
+def test_select_transits_first_or_all():
+    # Transits of 0.2 days every 10 days from 5, in a light curve from 12 to 48.
+    row, epochs, start, stop = quicklook.select_transits(12., 48., 5., 10., 0.2)
+    assert epochs.tolist() == [1]
+    assert start.tolist() == pytest.approx([14.9])
+    row, epochs, start, stop = quicklook.select_transits(12., 48., 5., 10., 0.2, True)
+    assert epochs.tolist() == [1, 2, 3, 4]
+    # The first transit after TSTART is dropped if it doesn't lie inside.
+    row, epochs, _, _ = quicklook.select_transits(12., 14.95, 5., 10., 0.2)
+    assert not len(epochs)
+
+def test_transit_times_includes_partial_transits():
+    _, epochs, start, stop = quicklook.transit_times(14.95, 35.05, 5., 10., 0.2)
+    assert epochs.tolist() == [1, 2, 3]
+    assert start[0] < 14.95 and stop[-1] > 35.05
+
+def test_transits_before_the_catalog_epoch(light_curve):
+    # The light curve ends long before i_epoch, so every epoch is negative.
+    filename = light_curve(7, 100., 130.)
+    clips, _ = quicklook.gather_data(filename, index((7, 1005., 10., 5.)), all_transits=True)
+    positives = [s for s, _ in clips if "negative" not in s]
+    assert positives == ["quicklook_e-0090", "quicklook_e-0089", "quicklook_e-0088"]
+    assert [suffixes.split(s)[3] for s in positives] == [-90, -89, -88]
+
+def test_free_intervals_merges_overlaps():
+    starts, stops = quicklook.free_intervals(0., 10., [6., 1., 2.], [7., 3., 4.])
+    assert starts.tolist() == [0., 4., 7.]
+    assert stops.tolist() == [1., 6., 10.]
+
+def test_free_intervals_clamps_to_light_curve():
+    starts, stops = quicklook.free_intervals(0., 10., [-5., 8.], [2., 15.])
+    assert starts.tolist() == [2.]
+    assert stops.tolist() == [8.]
+    starts, stops = quicklook.free_intervals(0., 10., [], [])
+    assert (starts.tolist(), stops.tolist()) == ([0.], [10.])
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sample_negative_windows_avoid_and_dont_overlap(seed):
+    np.random.seed(seed)
+    avoid_start = np.array([5., 20., 21., 60.])
+    avoid_stop = np.array([6., 25., 22., 70.])
+    start, stop = quicklook.sample_negative_windows(0., 100., avoid_start, avoid_stop, 8,
+        lower=2., upper=4.)
+    assert len(start) == 8
+    assert np.all((stop - start >= 2.) & (stop - start <= 4.))
+    assert np.all((start >= 0.) & (stop <= 100.))
+    order = np.argsort(start)
+    assert np.all(start[order][1:] >= stop[order][:-1])
+    for a, b in zip(avoid_start, avoid_stop):
+        assert not np.any((start < b) & (stop > a))
+
+def test_sample_negative_windows_settles_for_fewer():
+    failures.take()
+    start, stop = quicklook.sample_negative_windows(0., 10., [2.], [9.], 3,
+        lower=1.5, upper=2.)
+    assert len(start) == 1
+    assert failures.take() == {failures.NO_NEGATIVE: 1}
+
+def negatives(clips):
+    return [t for s, t in clips if "negative" in s]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_negatives_avoid_data_gaps(light_curve, seed):
+    # Two days without data, like a downlink, in a light curve from 100 to 110.
+    filename = light_curve(3, 100., 110., gaps=[(104., 106.)])
+    np.random.seed(seed)
+    clips, _ = quicklook.gather_data(filename, index((3, 101.5, 100., 5.)), negatives=4)
+    assert len(negatives(clips)) == 4
+    for t in negatives(clips):
+        time = np.asarray(t["TIME"])
+        assert len(time) * 0.0204 >= quicklook.NEG_LOWER * quicklook.NEG_MIN_COVERAGE
+        assert np.diff(time).max() < 0.1
+
+@pytest.mark.parametrize("all_transits", (False, True))
+def test_negatives_avoid_every_transit(light_curve, all_transits):
+    filename = light_curve(4, 100., 130.)
+    np.random.seed(0)
+    clips, _ = quicklook.gather_data(filename, index((4, 101., 3., 5.)), all_transits,
+                                     negatives=5)
+    transits = 101. + 3. * np.arange(10)
+    for t in negatives(clips):
+        assert not np.any((transits > t["TIME"][0] - 0.2) & (transits < t["TIME"][-1] + 0.2))
+
+def test_negatives_short_of_cadences_are_dropped(light_curve, monkeypatch):
+    # After 105 three of every five cadences are missing, which is too little
+    # at a time to count as gaps.
+    holes = [(t + 0.01, t + 0.07) for t in np.arange(105., 110., 5 * 0.0204)]
+    filename = light_curve(5, 100., 110., gaps=holes)
+    monkeypatch.setattr(quicklook, "sample_negative_windows",
+        lambda *args, **kwargs: (np.array([102., 107.]), np.array([103., 108.])))
+    failures.take()
+    clips, _ = quicklook.gather_data(filename, index((5, 100.5, 100., 5.)), negatives=2)
+    assert [t["TIME"][0] for t in negatives(clips)] == pytest.approx([102.], abs=0.03)
+    assert failures.take() == {failures.NO_NEGATIVE: 1}
+
+def test_recorder_skips_the_store_for_inputs_without_clips(tmp_path):
+    clipstore = pytest.importorskip("clipstore")
+    pytest.importorskip("h5py")
+    store = clipstore.ClipStore(str(tmp_path / "c.h5"), "a")
+    recorder = quicklook.Recorder(store=store)
+    # Failed inputs need not be named after a KIC ID.
+    recorder.add(("notes.txt", "error", 0), [], failed={failures.OTHER: 1})
+    recorder.flush()
+    assert len(store) == 0
+    store.close()
+
+def test_hdf5_run_goes_on_after_a_bad_input_name(tmp_path, light_curve, catalog, monkeypatch):
+    clipstore = pytest.importorskip("clipstore")
+    pytest.importorskip("h5py")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notes.txt").write_text("not a light curve")
+    files = ["notes.txt", light_curve(1)]
+    quicklook.main(files + ["--catalog", catalog([(1, 103., 10., 5., 0)]), "--order", "given",
+                            "--output-format", "hdf5", "--output", "c.h5"])
+    with clipstore.ClipStore("c.h5") as store:
+        assert len(store) == 2
+    status = quicklook.ascii.read("quicklook_status.ecsv", format="ecsv")
+    assert list(status["STATUS"]) == ["error", "ok"]
+
+def test_plan_windows_match_select_transits():
+    table_start = np.array([12., 100.])
+    table_stop = np.array([48., 140.])
+    epoch, period, dur = np.array([5., 3.]), np.array([10., 7.]), np.array([0.2, 0.1])
+    row, epochs, start, stop, ts, tp = quicklook.plan_windows(table_start, table_stop,
+        epoch, period, dur, True, seeds=[1, 2])
+    for k in range(2):
+        _, expected, _, _ = quicklook.select_transits(table_start[k], table_stop[k],
+            epoch[k], period[k], dur[k], True)
+        keep = quicklook.clip_fits(table_start[k], table_stop[k], start[row == k],
+                                   stop[row == k], True)
+        assert set(epochs[row == k]) <= set(expected)
+        assert keep.all()
+    assert np.all(start < ts) and np.all(stop > tp)
+
+def extract(filename, injected_index, plan=None, *options):
+    """-> clips of a light curve as quicklook.py would cut them with options."""
+    args = quicklook.parse_args([filename] + list(options))
+    return quicklook.extract_file(filename, injected_index, args, plan, write=False)[1]
+
+@pytest.mark.parametrize("all_transits", (False, True))
+def test_planned_clips_match_unplanned(tmp_path, light_curve, all_transits):
+    injected = index((1, 103., 7., 5.), (2, 101., 3., 3., 1))
+    files = [light_curve(1), light_curve(2)]
+    options = ["--all-transits"] if all_transits else []
+    plan = quicklook.make_plan(files, injected, all_transits)
+    quicklook.ascii.write(plan, str(tmp_path / "plan.ecsv"), format="ecsv")
+    windows, _ = quicklook.load_plan(str(tmp_path / "plan.ecsv"))
+    for f in files:
+        planned = extract(f, injected, windows, *options)
+        unplanned = extract(f, injected, None, *options)
+        positives = [(s, list(t["TIME"])) for s, t in planned if "negative" not in s]
+        assert positives == [(s, list(t["TIME"])) for s, t in unplanned if "negative" not in s]
+        assert len(positives) == (plan["FILE"] == f).sum() > 0
+
+@pytest.mark.parametrize("spec", ["svm=fixed", "lstm=random:4", "fixed:0.5", "lstm2=random",
+                                  "x_1=random:2"])
+def test_policy_names(spec):
+    policy = quicklook.parse_policy(spec)
+    for copy in range(policy.copies):
+        prefix = quicklook.policy_prefix(policy, copy)
+        assert suffixes.split(suffixes.with_epoch(prefix, 3))[1] == policy.name
+
+@pytest.mark.parametrize("name", ["negative", "views", "raw", "header", "e0001", "foo_01",
+                                  "a/b", "x y", "foo_e0002"])
+def test_ambiguous_policy_names_are_rejected(name):
+    with pytest.raises(ValueError):
+        quicklook.parse_policy(name + "=fixed")
+    with pytest.raises(SystemExit):
+        quicklook.parse_args(["--policy", name + "=random"])
+
+def test_policy_file_names_are_checked(tmp_path):
+    filename = str(tmp_path / "policies.json")
+    with open(filename, "w") as f:
+        f.write('[{"name": "negative"}]')
+    with pytest.raises(SystemExit):
+        quicklook.parse_args(["--policies", filename])
+
+def test_plan_windows_seeded_per_light_curve():
+    args = (np.array([12., 100.]), np.array([48., 140.]), np.array([5., 3.]),
+            np.array([10., 7.]), np.array([0.2, 0.1]), True)
+    both = quicklook.plan_windows(*args, seeds=[1, 2])
+    second = quicklook.plan_windows(*(a[1:] if isinstance(a, np.ndarray) else a
+                                      for a in args), seeds=[2])
+    assert np.array_equal(both[2][both[0] == 1], second[2])
+
+def test_plans_dont_depend_on_the_other_files(light_curve):
+    injected = index((1, 103., 7., 5.), (2, 101., 3., 3.), (3, 102., 9., 4.))
+    files = [light_curve(k) for k in (1, 2, 3)]
+    everything = quicklook.make_plan(files, injected, True)
+    alone = quicklook.make_plan(files[1:2], injected, True)
+    assert list(alone["START"]) == list(everything["START"][everything["FILE"] == files[1]])
+
+@pytest.mark.parametrize("all_transits", (False, True))
+def test_negatives_dont_depend_on_the_padding_drawn(tmp_path, light_curve, all_transits):
+    injected = index((1, 103., 7., 5.))
+    filename = light_curve(1)
+    plan = quicklook.make_plan([filename], injected, all_transits)
+    quicklook.ascii.write(plan, str(tmp_path / "plan.ecsv"), format="ecsv")
+    windows, _ = quicklook.load_plan(str(tmp_path / "plan.ecsv"))
+    options = ["--negatives", "3"] + (["--all-transits"] if all_transits else [])
+    negatives = [[(s, list(t["TIME"])) for s, t in extract(filename, injected, w, *options)
+                  if "negative" in s] for w in (None, windows)]
+    assert len(negatives[0]) == 3
+    assert negatives[0] == negatives[1]
+
+def test_guided_chunks_cover_files_and_shrink(tmp_path):
+    files = []
+    for k, size in enumerate([800, 400, 200, 100, 100, 50, 50, 10]):
+        f = tmp_path / "{}.fits".format(k)
+        f.write_bytes(b"\0" * size)
+        files.append(str(f))
+    chunks = quicklook.guided_chunks(files, 2)
+    assert [f for chunk in chunks for f in chunk] == files
+    assert len(chunks[-1]) <= len(chunks[0]) or len(chunks) == 1
+    assert len(chunks) > 1
+
+def test_inputs_from_lists_and_globs(tmp_path):
+    for name in ("a.fits", "sub/b.fits", "sub/deeper/c.fits", "sub/notes.txt"):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b"\0" * len(name))
+    (tmp_path / "list.txt").write_text("# light curves\n{}\n\n".format(tmp_path / "a.fits"))
+    args = quicklook.parse_args(["x.fits", "--files-from", str(tmp_path / "list.txt"),
+                                 "--glob", str(tmp_path / "sub/**/*.fits")])
+    assert sorted(quicklook.iter_inputs(args)) == sorted(
+        ["x.fits", str(tmp_path / "a.fits"), str(tmp_path / "sub/b.fits"),
+         str(tmp_path / "sub/deeper/c.fits")])
+    files = list(quicklook.iter_inputs(args))[1:]
+    assert quicklook.largest_first(files) == [str(tmp_path / "sub/deeper/c.fits"),
+                                              str(tmp_path / "sub/b.fits"),
+                                              str(tmp_path / "a.fits")]
@@ -0,0 +1,60 @@
+from astropy import table
+import glob
+import numpy as np
+import os
+
+import quicklook
+import rewindow
+import suffixes
+
+def test_raw_negative_windows_are_capped_free_intervals():
+    np.random.seed(0)
+    start, stop = quicklook.raw_negative_windows(0., 30., [2., 10.], [3., 11.], 3,
+        lower=0.5, upper=6.)
+    order = np.argsort(start)
+    assert len(start) == 3
+    assert np.all(stop - start <= 6.) and np.all(stop - start >= 0.5)
+    for a, b in ((2., 3.), (10., 11.)):
+        assert not np.any((start < b) & (stop > a))
+    assert np.all(start[order][1:] >= stop[order][:-1])
+
+def test_short_period_stars_get_raw_negatives(light_curve):
+    # Transits every 3 days leave no room for a RAW_NEGATIVE long window.
+    filename = light_curve(8, 100., 130.)
+    index = quicklook.injection.InjectedIndex({"KIC_ID": np.array([8]),
+        "i_epoch": np.array([101.]), "i_period": np.array([3.]), "i_dur": np.array([4.]),
+        "EB_injection": np.array([0])})
+    np.random.seed(0)
+    quicklook.failures.take()
+    clips, _ = quicklook.gather_data(filename, index, negatives=2, raw_pad=2.)
+    negatives = [t for s, t in clips if "negative" in s]
+    assert len(negatives) == 2
+    assert not quicklook.failures.take()
+    transits = 101. + 3. * np.arange(10)
+    for t in negatives:
+        assert t["TIME"][-1] - t["TIME"][0] <= quicklook.RAW_NEGATIVE
+        half = 4. / 48
+        assert not np.any((transits > t["TIME"][0] - half) & (transits < t["TIME"][-1] + half))
+
+def test_rewindow_negative_avoids_gaps():
+    time = np.concatenate((np.arange(0., 2., 0.0204), np.arange(4., 6., 0.0204)))
+    raw = table.Table([time, np.ones(len(time))], names=("TIME", "SAP_FLUX"))
+    for seed in range(20):
+        np.random.seed(seed)
+        for t in rewindow.rewindow_negative(raw, 2, 0.5, 1.):
+            assert np.diff(t["TIME"]).max() < 0.1
+
+def test_negatives_of_several_raw_negatives_get_distinct_names(tmp_path, light_curve,
+                                                               catalog, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    filename = light_curve(9, 100., 130.)
+    quicklook.main([filename, "--catalog", catalog([(9, 101., 3., 4., 0)]), "--raw",
+                    "--negatives", "3", "--no-journal"])
+    raw = sorted(glob.glob("*_quicklook_raw_negative*.ecsv"))
+    assert len(raw) == 3
+    os.mkdir("out")
+    rewindow.main(raw + ["--negatives", "2", "--outdir", "out"])
+    names = sorted(f[f.index("quicklook"):-len(".ecsv")] for f in os.listdir("out"))
+    assert len(names) == 6
+    assert [suffixes.split(s) for s in names] == [
+        (False, "negative", k or None, None) for k in range(6)]
@@ -0,0 +1,28 @@
+import pytest
+
+import suffixes
+
+@pytest.mark.parametrize("suffix, parts", [
+    ("quicklook", (False, "", None, None)),
+    ("quicklook_negative", (False, "negative", None, None)),
+    ("quicklook_negative_02", (False, "negative", 2, None)),
+    ("quicklook_views", (False, "views", None, None)),
+    ("quicklook_raw", (True, "", None, None)),
+    ("quicklook_raw_negative_01", (True, "negative", 1, None)),
+    ("quicklook_e0012", (False, "", None, 12)),
+    ("quicklook_e12345", (False, "", None, 12345)),
+    ("quicklook_lstm_03_e0012", (False, "lstm", 3, 12)),
+    ("quicklook_svm_e-0094", (False, "svm", None, -94)),
+    ("quicklook_raw_e-0001", (True, "", None, -1)),
+])
+def test_split(suffix, parts):
+    assert suffixes.split(suffix) == parts
+
+@pytest.mark.parametrize("epoch", [0, 7, 9999, 12345, -1, -94, -12345])
+def test_epochs_round_trip(epoch):
+    suffix = suffixes.with_epoch("quicklook_lstm_02", epoch)
+    assert suffixes.split(suffix) == (False, "lstm", 2, epoch)
+
+def test_not_a_suffix():
+    with pytest.raises(ValueError):
+        suffixes.split("header")
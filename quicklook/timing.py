@@ -0,0 +1,135 @@
+import collections
+import json
+import numpy as np
+import threading
+import time
+
+# Upper bounds of the wall time histogram buckets, in seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1., 2.5, 5., 10., 30., np.inf)
+
+class Stage(object):
+    """Context manager adding the wall time, CPU time and any bytes set on
+    it to a stage of the file being processed."""
+
+    def __init__(self, totals, name):
+        self.totals = totals
+        self.name = name
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        total = self.totals[self.name]
+        total[0] += time.perf_counter() - self.wall
+        total[1] += time.thread_time() - self.cpu
+        total[2] += self.nbytes
+        return False
+
+class NullStage(object):
+    """Stand-in for Stage while timing is disabled."""
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+# Whether timing is enabled; while it isn't, stage() costs one global lookup.
+_enabled = False
+# .totals is stage -> [wall, cpu, bytes] of the file being processed by
+# each thread, so that e.g. the reader threads of quicklook's pipeline
+# don't mix the stages of the files they read ahead with the one computed.
+_local = threading.local()
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def _totals():
+    try:
+        return _local.totals
+    except AttributeError:
+        _local.totals = collections.defaultdict(lambda: [0., 0., 0])
+        return _local.totals
+
+def stage(name):
+    if not _enabled:
+        return NULL_STAGE
+    return Stage(_totals(), name)
+
+def take():
+    """-> dictionary of stage to (wall, cpu, bytes) of this thread since its
+    last take()."""
+    if not _enabled:
+        return {}
+    totals = _totals()
+    out = {k: tuple(v) for k, v in totals.items()}
+    totals.clear()
+    return out
+
+def merge(*timings):
+    """-> sum of several dictionaries returned by take()."""
+    out = {}
+    for t in timings:
+        for k, v in t.items():
+            out[k] = tuple(a + b for a, b in zip(out[k], v)) if k in out else v
+    return out
+
+class StageStats(object):
+    """Per-file stage timings of a whole run."""
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add_file(self, timings):
+        for name, values in timings.items():
+            self.stages.setdefault(name, []).append(values)
+
+    def summary(self):
+        """-> dictionary of stage to totals, quantiles and a histogram of
+        the per-file wall times."""
+        out = collections.OrderedDict()
+        for name, values in self.stages.items():
+            wall, cpu, nbytes = np.array(values, dtype=float).T
+            counts = np.bincount(np.searchsorted(BUCKETS, wall), minlength=len(BUCKETS))
+            out[name] = collections.OrderedDict([
+                ("files", len(wall)), ("wall_seconds", wall.sum()),
+                ("cpu_seconds", cpu.sum()), ("bytes", int(nbytes.sum())),
+                ("wall_p50", np.percentile(wall, 50)),
+                ("wall_p90", np.percentile(wall, 90)),
+                ("wall_p99", np.percentile(wall, 99)),
+                ("wall_max", wall.max()),
+                ("histogram", [[str(b), int(c)] for b, c in zip(BUCKETS, counts)])])
+        return out
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, filename):
+        """Write the stages in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = ["# TYPE quicklook_stage_seconds histogram"]
+        for name, s in summary.items():
+            cumulative = np.cumsum([c for _, c in s["histogram"]])
+            for (b, _), c in zip(s["histogram"], cumulative):
+                le = "+Inf" if b == "inf" else b
+                lines.append('quicklook_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    name, le, c))
+            lines.append('quicklook_stage_seconds_sum{{stage="{}"}} {}'.format(
+                name, s["wall_seconds"]))
+            lines.append('quicklook_stage_seconds_count{{stage="{}"}} {}'.format(
+                name, s["files"]))
+        for metric, key in (("cpu_seconds_total", "cpu_seconds"), ("bytes_total", "bytes")):
+            lines.append("# TYPE quicklook_stage_{} counter".format(metric))
+            for name, s in summary.items():
+                lines.append('quicklook_stage_{}{{stage="{}"}} {}'.format(metric, name, s[key]))
+        with open(filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
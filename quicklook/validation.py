@@ -0,0 +1,57 @@
+import numpy as np
+
+# Steps between finite times longer than this many median cadences are gaps.
+GAP_CADENCES = 5.
+
+class LightCurveReport(object):
+    """Sanity checks of a light curve, computed in one NumPy pass.
+
+    monotonic tells whether the finite times strictly increase, with the
+    offending row indices in violations. finite_time, finite_flux and
+    flagged (non-zero SAP_QUALITY) are per-cadence masks and good combines
+    them. gaps holds (start, stop) times of the gaps in the time coverage.
+    """
+
+    def __init__(self, time_col, flux_col=None, quality_col=None, gap_cadences=GAP_CADENCES):
+        time_col = np.asarray(time_col)
+        self.length = len(time_col)
+        self.finite_time = np.isfinite(time_col)
+        if flux_col is None:
+            self.finite_flux = np.ones(self.length, dtype=bool)
+        else:
+            self.finite_flux = np.isfinite(flux_col)
+        if quality_col is None:
+            self.flagged = np.zeros(self.length, dtype=bool)
+        else:
+            self.flagged = np.asarray(quality_col) != 0
+        self.good = self.finite_time & self.finite_flux & ~self.flagged
+        rows = np.flatnonzero(self.finite_time)
+        step = np.diff(time_col[rows])
+        self.violations = rows[1:][step <= 0]
+        self.monotonic = not len(self.violations)
+        cadence = np.median(step) if len(step) else 0.
+        gap = np.flatnonzero(step > gap_cadences * cadence) if cadence > 0 else rows[:0]
+        self.gaps = np.column_stack((time_col[rows[gap]], time_col[rows[gap + 1]]))
+        self.cadence = cadence
+        # Running count of non-finite times, so that any window can be
+        # checked without scanning it.
+        self._bad_times = np.concatenate(([0], np.cumsum(~self.finite_time)))
+
+    def finite_times(self, i_start, i_stop):
+        """-> whether every time in rows [i_start, i_stop) is finite."""
+        return self._bad_times[i_stop] == self._bad_times[i_start]
+
+    def summary(self):
+        """-> dictionary of counts for logging."""
+        return {"cadences": self.length, "monotonic": self.monotonic,
+                "violations": len(self.violations),
+                "nonfinite_time": int(self.length - self.finite_time.sum()),
+                "nonfinite_flux": int(self.length - self.finite_flux.sum()),
+                "flagged": int(self.flagged.sum()), "gaps": len(self.gaps)}
+
+def validate_light_curve(data):
+    """-> LightCurveReport of a Kepler light curve FITS table."""
+    names = data.dtype.names
+    return LightCurveReport(data["TIME"],
+        data["SAP_FLUX"] if "SAP_FLUX" in names else None,
+        data["SAP_QUALITY"] if "SAP_QUALITY" in names else None)